@@ -0,0 +1,375 @@
+#Purpose: Time the intrographics hot paths and the demos, and compare with an earlier run
+#
+#   python benchmark.py                      run everything, print a table
+#   python benchmark.py --output new.json    also save the results
+#   python benchmark.py --baseline old.json  compare with a saved run
+#   python benchmark.py --full               include the 100000 shape sizes
+#
+#Runs on the headless backend unless INTROGRAPHICS_BACKEND says otherwise.
+#
+#A few private calls are used on purpose: _flush() so drawing work lands inside the timed
+#region, _finish() to tear down windows that were never opened (close() ignores those),
+#_sys.toHex() to time color conversion alone, and _writeImage()/_sys.photos to make and
+#reload test pictures without a display. _finish() also ends runAsync() runs without the
+#output line close() prints.
+
+import os
+import sys
+import json
+import random
+import timeit
+import threading
+import tempfile
+import argparse
+import platform
+import subprocess
+try:
+    import trollius
+except ImportError:
+    trollius = None
+
+os.environ.setdefault("INTROGRAPHICS_BACKEND", "headless")
+import intrographics
+
+here = os.path.dirname(os.path.abspath(__file__))
+demos = ["bounce.py", "frogger.py", "migrate.py", "grow.py", "flash.py", "strobe.py"]
+
+#Time a function that does some number of operations, keeping the best of several tries
+#setup() returns (run, windows): run() is timed, or times itself by returning seconds, and the windows are torn down after
+def measure(function, operations, repeat):
+    best = None
+    for i in range(repeat):
+        random.seed(1)
+        (run, windows) = function()
+        try:
+            start = timeit.default_timer()
+            seconds = run()
+            if seconds is None:
+                seconds = timeit.default_timer() - start
+        finally:
+            for window in windows:
+                window._finish()
+        best = seconds if best is None else min(best, seconds)
+    return {"operations": operations, "seconds": best, "rate": operations / max(best, 1e-9)}
+
+#Make a window with some random shapes of one kind
+def crowd(kind, count, size=10, width=800, height=800):
+    window = intrographics.window(width, height)
+    shapes = [add(window, kind, random.randint(0, width-size), random.randint(0, height-size), size) for i in range(count)]
+    window._flush()
+    return (window, shapes)
+
+#Make a picture file of random pixels, in the format its extension names
+def picture(size, kind="gif"):
+    path = os.path.join(tempfile.gettempdir(), "intrographics-benchmark-%d.%s" % (size, kind))
+    intrographics._writeImage(path, size, size, lambda row, count : bytearray(os.urandom(size*count*3)))
+    return path
+
+#Add one shape of a kind
+def add(window, kind, x, y, size):
+    if kind == "rectangle":
+        return window.addRectangle(x, y, size, size)
+    if kind == "oval":
+        return window.addOval(x, y, size, size)
+    if kind == "polygon":
+        return window.addPolygon((x, y), (x+size, y), (x+size/2, y+size))
+    if kind == "line":
+        return window.addLine((x, y), (x+size, y+size), (x+size, y))
+    if kind == "text":
+        return window.addText(x, y, "text")
+
+#Shape creation
+def create(kind, count):
+    def setup():
+        window = intrographics.window(800, 800)
+        places = [(random.randint(0, 790), random.randint(0, 790)) for i in range(count)]
+        def run():
+            for (x, y) in places:
+                add(window, kind, x, y, 10)
+            window._flush()
+        return (run, [window])
+    return setup
+
+#Moving every shape of a kind several times
+def move(kind, count, rounds):
+    def setup():
+        (window, shapes) = crowd(kind, count)
+        def run():
+            for i in range(rounds):
+                for shape in shapes:
+                    shape.move(1, -1)
+                window._flush()
+        return (run, [window])
+    return setup
+
+#Removing every shape, one at a time or all at once
+def teardown(kind, count):
+    def setup():
+        (window, shapes) = crowd("rectangle", count)
+        def run():
+            if kind == "remove":
+                for shape in shapes:
+                    window.remove(shape)
+            else:
+                window.clear()
+        return (run, [window])
+    return setup
+
+#Posting shape moves from a worker thread and running them at the next frame
+def posts(count):
+    def setup():
+        (window, shapes) = crowd("rectangle", 100)
+        def post():
+            for i in range(count):
+                window.post(shapes[i % 100].move, 1, -1)
+        def run():
+            worker = threading.Thread(target=post)
+            worker.start()
+            worker.join()
+            window.simulate(1)
+        return (run, [window])
+    return setup
+
+#Posting shape moves from a worker thread while a trollius loop runs the window, until they have all run
+def asyncPosts(count):
+    def setup():
+        (window, shapes) = crowd("rectangle", 100)
+        loop = trollius.get_event_loop()
+        def post():
+            for i in range(count):
+                window.post(shapes[i % 100].move, 1, -1)
+            window.post(window._finish)
+        def run():
+            before = sum(shape.left for shape in shapes)
+            worker = threading.Thread(target=post)
+            loop.call_soon(worker.start)
+            giveUp = loop.call_later(30, window._finish)
+            loop.run_until_complete(window.runAsync(100))
+            giveUp.cancel()
+            worker.join()
+            if sum(shape.left for shape in shapes) - before != count:
+                raise RuntimeError("Moves posted from a thread under runAsync() did not all run.")
+        return (run, [window])
+    return setup
+
+#Collision queries at one density
+def touching(count, queries):
+    def setup():
+        (window, shapes) = crowd("rectangle", count)
+        probes = [random.choice(shapes) for i in range(queries)]
+        def run():
+            for shape in probes:
+                window.touching(shape)
+        return (run, [window])
+    return setup
+
+#Point queries at one density
+def under(count, queries):
+    def setup():
+        (window, shapes) = crowd("rectangle", count)
+        points = [(random.randint(0, 800), random.randint(0, 800)) for i in range(queries)]
+        def run():
+            for (x, y) in points:
+                window.under(x, y)
+        return (run, [window])
+    return setup
+
+#Timer dispatch with empty handlers
+def timers(count, milliseconds):
+    def setup():
+        window = intrographics.window(100, 100)
+        for i in range(count):
+            def tick():
+                pass
+            window.startTimer(10, tick)
+        def run():
+            window.simulate(milliseconds)
+        return (run, [window])
+    return setup
+
+#Color conversion
+def colors(kind, count):
+    def setup():
+        window = intrographics.window(10, 10)
+        if kind == "named":
+            values = [random.choice(["red", "blue", "green", "black", "white", "gray50"]) for i in range(count)]
+        elif kind == "tuple":
+            values = [(random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)) for i in range(count)]
+        else:
+            values = [intrographics.color(random.choice(["red", "blue", "green"])) for i in range(count)]
+        toHex = intrographics._sys.toHex
+        def run():
+            for value in values:
+                toHex(value)
+        return (run, [window])
+    return setup
+
+#Image pixel access, one pixel at a time or all at once, and filters
+def pixels(kind, size):
+    path = picture(size)
+    def setup():
+        window = intrographics.window(size, size)
+        picture = window.addImage(0, 0, path)
+        def run():
+            if kind == "get":
+                for row in range(size):
+                    for col in range(size):
+                        picture[col, row]
+            elif kind == "put":
+                for row in range(size):
+                    for col in range(size):
+                        picture[col, row] = (col % 256, row % 256, 0)
+            elif kind == "filter":
+                picture.convolve([[1, 2, 1], [2, 4, 2], [1, 2, 1]]).colorMatrix([[0.3, 0.59, 0.11]]*3).rotate(90)
+                window._flush()
+            else:
+                picture.setPixels(picture.pixels())
+        return (run, [window])
+    return setup
+
+#Adding many images of the same file
+def images(count, size=32):
+    path = picture(size)
+    def setup():
+        window = intrographics.window(800, 800)
+        def run():
+            for i in range(count):
+                window.addImage(i % 800, i % 800, path)
+            window._flush()
+        return (run, [window])
+    return setup
+
+#Loading and saving an image file in one format
+def files(kind, size):
+    path = picture(size, kind)
+    def setup():
+        window = intrographics.window(size, size)
+        def run():
+            intrographics._sys.photos.clear()
+            window.addImage(0, 0, path).saveAs(path)
+        return (run, [window])
+    return setup
+
+#Run a demo for some simulated time, timing only its simulation inside the child process
+def demo(name, milliseconds):
+    def setup():
+        environment = dict(os.environ, INTROGRAPHICS_SIMULATE=str(milliseconds))
+        def run():
+            (handle, timing) = tempfile.mkstemp(suffix=".txt")
+            os.close(handle)
+            try:
+                with open(os.devnull, "w") as quiet:
+                    subprocess.check_call([sys.executable, "-c", timed, os.path.join(here, name), timing], env=environment, stdout=quiet, cwd=here)
+                with open(timing) as f:
+                    return float(f.read())
+            finally:
+                os.remove(timing)
+        return (run, [])
+    return setup
+
+#Child process code that runs a demo script and saves the seconds spent in window.simulate()
+timed = """
+import sys, runpy, timeit, intrographics
+simulate = intrographics.window.simulate
+spent = [0.0]
+def timedSimulate(self, *args):
+    start = timeit.default_timer()
+    try:
+        return simulate(self, *args)
+    finally:
+        spent[0] += timeit.default_timer() - start
+intrographics.window.simulate = timedSimulate
+timing = sys.argv[2]
+sys.argv = sys.argv[1:2]
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+finally:
+    with open(timing, "w") as f:
+        f.write(repr(spent[0]))
+"""
+
+#Start Python and import intrographics, the fixed cost every demo run pays outside its timing
+def startup():
+    def setup():
+        def run():
+            subprocess.check_call([sys.executable, "-c", "import intrographics"], cwd=here)
+        return (run, [])
+    return setup
+
+#Everything to run, as name -> (setup, operations)
+def benchmarks(full):
+    sizes = [1000, 10000] + ([100000] if full else [])
+    suite = []
+    for kind in ["rectangle", "oval", "polygon"]:
+        for count in sizes:
+            suite.append(("create.%s.%d" % (kind, count), create(kind, count), count))
+    for kind in ["rectangle", "oval", "polygon", "line", "text"]:
+        suite.append(("move.%s" % kind, move(kind, 1000, 20), 1000*20))
+    for kind in ["remove", "clear"]:
+        suite.append(("%s.%d" % (kind, sizes[-1]), teardown(kind, sizes[-1]), sizes[-1]))
+    suite.append(("post.10000", posts(10000), 10000))
+    if trollius is not None:
+        suite.append(("post.async.10000", asyncPosts(10000), 10000))
+    for count in [100, 1000, 10000]:
+        suite.append(("touching.%d" % count, touching(count, 1000), 1000))
+        suite.append(("under.%d" % count, under(count, 1000), 1000))
+    for count in [1, 10, 100]:
+        suite.append(("timers.%d" % count, timers(count, 10000), count*1000))
+    for kind in ["named", "tuple", "value"]:
+        suite.append(("color.%s" % kind, colors(kind, 100000), 100000))
+    for kind in ["get", "put", "bulk", "filter"]:
+        suite.append(("image.%s" % kind, pixels(kind, 64), 64*64))
+    if full:
+        suite.append(("image.filter.512", pixels("filter", 512), 512*512))
+    suite.append(("image.add", images(200), 200))
+    for kind in ["gif", "png", "ppm"]:
+        suite.append(("file.%s" % kind, files(kind, 128), 128*128))
+    suite.append(("demo.startup", startup(), 1))
+    for name in demos:
+        suite.append(("demo.%s" % name[:-3], demo(name, 10000), 1))
+    return suite
+
+#Show results, with the speedup over a baseline when there is one
+def report(results, baseline, threshold):
+    slower = []
+    for name in sorted(results):
+        result = results[name]
+        line = "%-24s %12.1f ops/s %10.3f ms" % (name, result["rate"], result["seconds"]*1000)
+        if name in baseline:
+            speedup = baseline[name]["seconds"] / max(result["seconds"], 1e-9)
+            line += "   %5.2fx" % speedup
+            if speedup < 1 - threshold:
+                line += "  slower"
+                slower.append(name)
+        print line
+    return slower
+
+parser = argparse.ArgumentParser(description="Benchmark intrographics.")
+parser.add_argument("--output", help="save the results to this JSON file")
+parser.add_argument("--baseline", help="compare with results saved earlier")
+parser.add_argument("--threshold", type=float, default=0.1, help="slowdown that counts as a regression (default 0.1)")
+parser.add_argument("--repeat", type=int, default=3, help="tries per benchmark, keeping the best (default 3)")
+parser.add_argument("--only", help="run only benchmarks whose names start with this")
+parser.add_argument("--full", action="store_true", help="include the largest sizes")
+options = parser.parse_args()
+
+results = {}
+for (name, setup, operations) in benchmarks(options.full):
+    if options.only and not name.startswith(options.only):
+        continue
+    results[name] = measure(setup, operations, options.repeat)
+    sys.stderr.write(".")
+sys.stderr.write("\n")
+
+baseline = {}
+if options.baseline:
+    with open(options.baseline) as f:
+        baseline = json.load(f)["results"]
+slower = report(results, baseline, options.threshold)
+
+if options.output:
+    with open(options.output, "w") as f:
+        json.dump({"python": platform.python_version(), "backend": os.environ["INTROGRAPHICS_BACKEND"], "results": results}, f, indent=2, sort_keys=True)
+if slower:
+    print len(slower), "benchmarks got slower:", ", ".join(slower)
+    sys.exit(1)
@@ -50,28 +50,24 @@ car4.vx=6
 
 # This function moves the obstacles
 def moveObstacle():
-    for obstacle in window:
-        if obstacle.group == "obstacles":
-            obstacle.move(obstacle.vx, 0)
-            if obstacle.left <= 0 or obstacle.right >= 600:
-                obstacle.vx = -obstacle.vx
-    for shape in window.touching(player):
-        if shape.group == "obstacles":
-            window.close()
+    for obstacle in window.group("obstacles"):
+        obstacle.move(obstacle.vx, 0)
+        if obstacle.left <= 0 or obstacle.right >= 600:
+            obstacle.vx = -obstacle.vx
+    if window.collisions("player", "obstacles"):
+        window.close()
 
 # This function moves the platforms
 def movePlatform():
-    for platform in window:
-        if platform.group == "platforms":
-            platform.move(platform.vx, 0)
-            if platform.left <= 0 or platform.right >= 600:
-                platform.vx = -platform.vx
-    for shape in window.touching(player):
-        if shape.group == "platforms":
-            player.move(player.vx, 0)
-            player.vx = shape.vx
-            if player.left <= 0 or player.right >= 600:
-                window.close()
+    for platform in window.group("platforms"):
+        platform.move(platform.vx, 0)
+        if platform.left <= 0 or platform.right >= 600:
+            platform.vx = -platform.vx
+    for (frog, platform) in window.collisions("player", "platforms"):
+        player.move(player.vx, 0)
+        player.vx = platform.vx
+        if player.left <= 0 or player.right >= 600:
+            window.close()
 
 # This function moves the player
 def navigate(key):
@@ -3,36 +3,88 @@
 # Documentation: http://myslu.stlawu.edu/~ltorrey/intrographics2
 #########################################################################
 
-import Tkinter
 import traceback
+import os
 import inspect
+import heapq
+import math
+import binascii
+import struct
+import time
+import sys
+import zlib
+import threading
+import Queue
+import ctypes
+import multiprocessing
+import mmap
+import shutil
+from array import array
+from operator import add
+from collections import deque, OrderedDict
+from multiprocessing.sharedctypes import RawArray
+try:
+    import Tkinter
+except ImportError:
+    Tkinter = None # Only the headless backend works without it
+try:
+    import numpy as _numpy
+except ImportError:
+    _numpy = None
+try:
+    import trollius as _asyncio
+except ImportError:
+    _asyncio = None
 
 # (Window manager)
 class _system:
     def __init__(self):
         self.root = None # Primary Tk frame
+        self.looping = False # Whether the primary frame's main loop is running, so other threads can hand it calls
         self.dependents = [] # Other windows
+        self.trusted = os.environ.get("INTROGRAPHICS_TRUSTED", "0") not in ["", "0"] # Optimize new windows
+        self.workers = int(os.environ.get("INTROGRAPHICS_WORKERS", "0")) or multiprocessing.cpu_count() # Processes for big image filters
+        self.profile = os.environ.get("INTROGRAPHICS_PROFILE", "0") # Profile new windows: "1", or "hud" to show it
+        self.colors = {} # Color name -> [hex, last use]
+        self.colorUses = 0
+        self.colorLimit = 1024
+        self.photos = {} # Absolute image filename -> [modification time, shared photo, last use]
+        self.photoUses = 0
+        self.photoLimit = 64
+        self.backend = _backends.get(os.environ.get("INTROGRAPHICS_BACKEND", "tk"), _tkBackend)() # Where drawing happens
+        self.simulation = None # Arguments for window.simulate() in place of showing windows
+        if os.environ.get("INTROGRAPHICS_SIMULATE"):
+            script = os.environ.get("INTROGRAPHICS_SCRIPT")
+            self.simulation = (int(os.environ["INTROGRAPHICS_SIMULATE"]), _readScript(script) if script else [])
 
-    # Create a Tkinter frame
+    # Create a frame
     def createFrame(self, window):
         if not self.root:
-            self.root = Tkinter.Tk()
+            self.root = self.backend.root()
             self.root.withdraw()
+            self.colors.clear()
+            self.photos.clear()
             return self.root
         else:
-            frame = Tkinter.Toplevel(self.root)
+            frame = self.backend.toplevel(self.root)
             self.dependents.append(window)
             frame.withdraw()
             return frame
 
-    # Show a Tkinter frame
-    def showFrame(self, window):
+    # Show a frame, and wait in the main loop if it is the primary one and nothing else drives it
+    def showFrame(self, window, wait=True):
         window._frame.update()
         window._frame.deiconify()
-        if window._frame == self.root:
-            self.root.mainloop()
+        if wait and window._frame == self.root:
+            self.looping = True
+            try:
+                for other in [window]+self.dependents: # Work posted from other threads just before the loop started
+                    other._wake()
+                self.root.mainloop()
+            finally:
+                self.looping = False
 
-    # Destroy a Tkinter frame
+    # Destroy a frame
     def destroyFrame(self, window):
         if window._frame == self.root:
             for window in self.dependents: window.close()
@@ -54,14 +106,71 @@ class _system:
                 return False
         return True
 
-    # Convert a color from string or (r,g,b) to hex
-    def toHex(self, color):
+    # Convert a color from string, (r,g,b) or color value to hex
+    def toHex(self, value):
+        if type(value) == tuple and len(value) == 3:
+            (r, g, b) = value
+            try:
+                if 0 <= r <= 255 and 0 <= g <= 255 and 0 <= b <= 255:
+                    return "#"+_hexDigits[int(r)]+_hexDigits[int(g)]+_hexDigits[int(b)]
+            except (TypeError, ValueError):
+                pass
+        elif isinstance(value, color):
+            return value.hex
+        colors = self.colors
         try:
-            if not self.isRGB(color):
-                color = tuple(map(lambda x : x/256, self.root.winfo_rgb(color)))
-            return "#%02x%02x%02x" % color
-        except:
-            raise Exception("Invalid color: "+str(color))
+            entry = colors.get(value)
+        except TypeError:
+            raise Exception("Invalid color: "+str(value))
+        if entry is None:
+            if self.root is None: # Tk can only look names up once a window exists, so use the common names until then
+                try:
+                    rgb = _rasterRGB(value)
+                except ValueError:
+                    raise Exception("Can't look up color "+str(value)+" before a window exists.")
+                if not rgb:
+                    raise Exception("Invalid color: "+str(value))
+                return "#"+binascii.hexlify(rgb)
+            try:
+                entry = ["#%02x%02x%02x" % tuple(map(lambda x : x/256, self.root.winfo_rgb(value))), 0]
+            except:
+                raise Exception("Invalid color: "+str(value))
+            if len(colors) >= self.colorLimit:
+                self.forgetColors()
+            colors[value] = entry
+        self.colorUses += 1
+        entry[1] = self.colorUses
+        return entry[0]
+
+    # Forget the least recently used half of the remembered color names
+    def forgetColors(self):
+        colors = self.colors
+        for name in sorted(colors, key=lambda name : colors[name][1])[:len(colors)-self.colorLimit//2]:
+            del colors[name]
+
+    # Get the photo for an image file, shared by every image of the file until it changes
+    def photo(self, filename):
+        key = os.path.abspath(filename)
+        try:
+            changed = os.path.getmtime(key)
+        except OSError:
+            changed = None
+        photos = self.photos
+        entry = photos.get(key)
+        if entry is None or entry[0] != changed:
+            if entry is None and len(photos) >= self.photoLimit:
+                self.forgetPhotos()
+            entry = [changed, self.backend.photo(self.root, filename), 0]
+            photos[key] = entry
+        self.photoUses += 1
+        entry[2] = self.photoUses
+        return entry[1]
+
+    # Forget the least recently used half of the shared photos; images still showing one keep their own
+    def forgetPhotos(self):
+        photos = self.photos
+        for key in sorted(photos, key=lambda key : photos[key][2])[:len(photos)-self.photoLimit//2]:
+            del photos[key]
 
     # Provide some error messages
     def extra(self, command):
@@ -80,11 +189,1480 @@ class _system:
         print "IntrographicsError:", message
         quit()
 
+# (Two hex digits for each color channel value)
+_hexDigits = ["%02x" % i for i in xrange(256)]
+
+# (Read input events for window.simulate() from lines like "500 key Up" or "800 leftClick 10 20")
+def _readScript(filename):
+    script = []
+    with open(filename) as f:
+        for line in f:
+            words = line.split("#")[0].split()
+            if words:
+                args = words[2:] if words[1] == "key" else map(int, words[2:])
+                script.append(tuple([float(words[0]), words[1]]+list(args)))
+    return script
+
+# (Uniform grid of shapes for fast collision queries)
+class _grid:
+    size = 64 # Cell width and height in pixels
+    limit = 256 # Shapes covering more cells than this are kept aside
+
+    def __init__(self):
+        self.cells = {} # (col,row) -> set of shapes
+        self.spans = {} # shape -> (col1,row1,col2,row2)
+        self.large = set() # Shapes too big to bucket
+
+    # (Find the range of cells covering a box)
+    def span(self, left, top, right, bottom):
+        size = self.size
+        return (int(left)//size, int(top)//size, int(right)//size, int(bottom)//size)
+
+    # (Add or re-bucket a shape after it changes)
+    def update(self, shape):
+        span = self.span(shape.left, shape.top, shape.right, shape.bottom)
+        old = self.spans.get(shape)
+        if span == old:
+            return
+        if old is not None:
+            self.remove(shape)
+        self.spans[shape] = span
+        (c1, r1, c2, r2) = span
+        if (c2-c1+1)*(r2-r1+1) > self.limit:
+            self.large.add(shape)
+            return
+        cells = self.cells
+        for c in xrange(c1, c2+1):
+            for r in xrange(r1, r2+1):
+                bucket = cells.get((c,r))
+                if bucket is None:
+                    cells[(c,r)] = set([shape])
+                else:
+                    bucket.add(shape)
+
+    # (Forget a shape)
+    def remove(self, shape):
+        span = self.spans.pop(shape, None)
+        if span is None:
+            return
+        if shape in self.large:
+            self.large.discard(shape)
+            return
+        (c1, r1, c2, r2) = span
+        cells = self.cells
+        for c in xrange(c1, c2+1):
+            for r in xrange(r1, r2+1):
+                bucket = cells[(c,r)]
+                bucket.discard(shape)
+                if not bucket:
+                    del cells[(c,r)]
+
+    # (Get the shapes whose boxes might overlap a box)
+    def query(self, left, top, right, bottom):
+        (c1, r1, c2, r2) = self.span(left, top, right, bottom)
+        found = set(self.large)
+        if (c2-c1+1)*(r2-r1+1) > len(self.cells):
+            for bucket in self.cells.itervalues():
+                found.update(bucket)
+            return found
+        cells = self.cells
+        for c in xrange(c1, c2+1):
+            for r in xrange(r1, r2+1):
+                bucket = cells.get((c,r))
+                if bucket:
+                    found.update(bucket)
+        return found
+
+# (Check whether the segment from (x1,y1) to (x2,y2) passes through a box)
+def _segmentHitsBox(x1, y1, x2, y2, left, top, right, bottom):
+    (start, end) = (0.0, 1.0)
+    (dx, dy) = (x2-x1, y2-y1)
+    for (p, q) in [(-dx, x1-left), (dx, right-x1), (-dy, y1-top), (dy, bottom-y1)]:
+        if p == 0:
+            if q < 0:
+                return False
+        elif p < 0:
+            start = max(start, float(q)/p)
+        else:
+            end = min(end, float(q)/p)
+        if start > end:
+            return False
+    return True
+
+# (Check whether the segment from (x1,y1) to (x2,y2) comes within a distance of a box)
+def _segmentNearBox(x1, y1, x2, y2, left, top, right, bottom, reach):
+    if _segmentHitsBox(x1, y1, x2, y2, left, top, right, bottom):
+        return True
+    limit = reach*reach # Apart from the box, the closest points are an end of the segment or a corner of the box
+    for (x, y) in [(x1, y1), (x2, y2)]:
+        (ex, ey) = (max(left-x, 0, x-right), max(top-y, 0, y-bottom))
+        if ex*ex + ey*ey <= limit:
+            return True
+    (dx, dy) = (x2-x1, y2-y1)
+    length = float(dx*dx + dy*dy)
+    if length == 0:
+        return False
+    for (x, y) in [(left, top), (right, top), (left, bottom), (right, bottom)]:
+        t = min(max(((x-x1)*dx + (y-y1)*dy)/length, 0.0), 1.0)
+        (ex, ey) = (x1 + t*dx - x, y1 + t*dy - y)
+        if ex*ex + ey*ey <= limit:
+            return True
+    return False
+
+#########################################################################
+# Backends: where windows and shapes are actually drawn
+#########################################################################
+
+# (Quote a value as one Tcl word; tuples become Tcl lists)
+def _tclWord(value):
+    if isinstance(value, (tuple, list)):
+        value = " ".join(map(_tclWord, value))
+    value = str(value)
+    if value == "":
+        return "{}"
+    return "".join([_tclEscapes.get(c, c) for c in value])
+
+# (Characters that need a backslash in a Tcl word)
+_tclEscapes = dict([(c, "\\"+c) for c in "\\{}[]$\"; "]+[("\n", "\\n"), ("\t", "\\t"), ("\r", "\\r")])
+
+# (Tk canvas that can apply a list of queued operations in one Tcl call)
+class _tkCanvas(Tkinter.Canvas if Tkinter is not None else object):
+    _procs = """
+proc _intrographics_create {c kind count tag} {
+    set ids {}
+    for {set i 0} {$i < $count} {incr i} {
+        lappend ids [$c create $kind 0 0 0 0 -width 0 -tags $tag]
+    }
+    return $ids
+}
+proc _intrographics_place {c ids coords} {
+    foreach id $ids {x y s} $coords {
+        $c coords $id $x $y [expr {$x+$s}] [expr {$y+$s}]
+    }
+}
+proc _intrographics_fill {c ids colors} {
+    foreach id $ids color $colors {
+        $c itemconfigure $id -fill $color
+    }
+}
+proc _intrographics_items {c} {
+    set items {}
+    foreach id [$c find all] {
+        set options {}
+        foreach option {-fill -outline -width -text -font -state -image} {
+            if {![catch {$c itemcget $id $option} value]} {
+                lappend options $option $value
+            }
+        }
+        if {[$c type $id] eq "window"} {
+            set w [$c itemcget $id -window]
+            if {[winfo class $w] eq "Entry"} {
+                lappend options -kind entry -message [$w get]
+            } else {
+                lappend options -kind button -message [$w cget -text]
+            }
+        }
+        lappend items [list [$c type $id] [$c coords $id] $options]
+    }
+    return [list [$c cget -width] [$c cget -height] [$c cget -background] $items]
+}
+"""
+
+    def __init__(self, master):
+        Tkinter.Canvas.__init__(self, master)
+        self.tk.eval(self._procs)
+
+    # (Apply operations as one Tcl script)
+    def batch(self, ops):
+        path = self._w
+        script = []
+        for op in ops:
+            if op[0] == "coords":
+                script.append(path+" coords "+str(op[1])+" "+" ".join(map(str, op[2])))
+            elif op[0] == "config":
+                script.append(path+" itemconfigure "+str(op[1])+" "+" ".join(["-"+k+" "+_tclWord(v) for (k,v) in op[2].iteritems()]))
+            elif op[0] == "place":
+                script.append("_intrographics_place "+path+" {"+" ".join(map(str, op[1]))+"} {"+" ".join(map(str, op[2]))+"}")
+            elif op[0] == "fill":
+                script.append("_intrographics_fill "+path+" {"+" ".join(map(str, op[1]))+"} {"+" ".join(op[2])+"}")
+            elif op[0] == "move":
+                script.append(path+" move "+str(op[1])+" "+str(op[2])+" "+str(op[3]))
+            elif op[0] == "insert":
+                script.append(path+" insert "+str(op[1])+" end {"+" ".join(map(str, op[2]))+"}")
+        self.tk.eval("\n".join(script))
+
+    # (Create many items with one Tcl call and return their ids)
+    def createBatch(self, kind, count, tag):
+        return tuple(map(int, self.tk.splitlist(self.tk.call("_intrographics_create", self._w, kind, count, tag))))
+
+    # (Copy the items into a raster canvas with one Tcl call, plus one per image; widgets are drawn the raster way)
+    def snapshot(self):
+        split = self.tk.splitlist
+        hex = lambda color : str(color) if str(color).startswith("#") else _sys.toHex(str(color))
+        (width, height, background, items) = split(self.tk.call("_intrographics_items", self._w))
+        copy = _rasterCanvas(None)
+        copy.configure(width=width, height=height, background=hex(background))
+        for item in split(items):
+            (kind, coords, options) = split(item)
+            kind = str(kind)
+            options = map(str, split(options))
+            options = dict([(options[i][1:], options[i+1]) for i in xrange(0, len(options), 2)])
+            coords = [float(str(c)) for c in split(coords)]
+            if kind in ["rectangle", "oval", "polygon", "line", "text"]:
+                for name in ["fill", "outline"]:
+                    if options.get(name, "") != "":
+                        options[name] = hex(options[name])
+                copy._create(kind, coords, options)
+            elif kind == "image" and options.get("image"):
+                name = options["image"]
+                photo = _rasterPhoto(None, int(self.tk.call("image", "width", name)), int(self.tk.call("image", "height", name)))
+                photo.data = _tkReadBlock(self.tk, name, 0, 0, photo.columns, photo.rows)
+                copy._create(kind, coords, {"image":photo, "state":options.get("state", "")})
+            elif kind == "window" and "kind" in options:
+                copy._create(kind, coords, {"window":_rasterWidget(options["kind"], text=options["message"]), "state":options.get("state", "")})
+        return copy
+
+    # (Draw the items with the raster renderer)
+    def render(self):
+        return self.snapshot().render()
+
+# (Tk photo image with block pixel access)
+class _tkPhoto(Tkinter.PhotoImage if Tkinter is not None else object):
+    # (Read a block of pixels as r,g,b bytes)
+    def readBlock(self, col, row, width, height):
+        return _tkReadBlock(self.tk, self.name, col, row, width, height)
+
+    # (Write a block of r,g,b bytes with one Tk call per band of rows)
+    def writeBlock(self, col, row, width, buffer):
+        step = width*6
+        for start in xrange(0, len(buffer), width*3*_bandRows):
+            digits = binascii.hexlify(buffer[start:start+width*3*_bandRows])
+            lines = []
+            for first in xrange(0, len(digits), step):
+                line = digits[first:first+step]
+                lines.append("{#"+" #".join([line[i:i+6] for i in xrange(0, step, 6)])+"}")
+            self.tk.call(self.name, "put", " ".join(lines), "-to", col, row+start//(width*3))
+
+    # (Copy a block into a new photo with one Tk call)
+    def slice(self, col, row, width, height):
+        photo = _tkPhoto(master=self.tk, width=width, height=height)
+        self.tk.call(photo.name, "copy", self.name, "-from", col, row, col+width, row+height)
+        return photo
+
+    # (Copy the whole photo into a new one)
+    def copy(self):
+        return self.slice(0, 0, self.width(), self.height())
+
+    # (Make a new empty photo)
+    def blank(self, width, height):
+        return _tkPhoto(master=self.tk, width=width, height=height)
+
+    # (Save to a file in the format its name ends with, letting Tk write the formats it knows)
+    def saveAs(self, filename):
+        kind = _imageFormat(filename)
+        if kind != "pgm":
+            try:
+                return self.write(filename, format=kind)
+            except Tkinter.TclError:
+                pass
+        _writeImage(filename, self.width(), self.height(), lambda row, count : self.readBlock(0, row, self.width(), count))
+
+# (Read a block of a Tk photo's pixels as r,g,b bytes with one Tk call per band of rows)
+def _tkReadBlock(tk, name, col, row, width, height):
+    block = bytearray()
+    for top in xrange(row, row+height, _bandRows):
+        bottom = min(top+_bandRows, row+height)
+        data = tk.call(name, "data", "-from", col, top, col+width, bottom)
+        lines = [r if isinstance(r, basestring) else " ".join(map(str, r)) for r in tk.splitlist(data)]
+        block += binascii.unhexlify("".join(lines).translate(None, "# {}"))
+    return block
+
+# (Backend that draws with Tk)
+class _tkBackend:
+    def root(self):
+        if Tkinter is None:
+            return _sys.error("Showing windows needs Tkinter, which this Python doesn't have; set INTROGRAPHICS_BACKEND=headless to draw without it.")
+        return Tkinter.Tk()
+    def toplevel(self, root):
+        return Tkinter.Toplevel(root)
+    def canvas(self, frame):
+        return _tkCanvas(frame)
+    def button(self, master, message):
+        return Tkinter.Button(master, text=message)
+    def variable(self, master, message):
+        return Tkinter.StringVar(master, value=message)
+    def entry(self, master, variable):
+        return Tkinter.Entry(master, textvariable=variable, relief="sunken", background="gray99")
+    def photo(self, master, filename):
+        try:
+            return _tkPhoto(master=master, file=filename)
+        except Tkinter.TclError:
+            (columns, rows, pixels) = _readImage(filename)
+            photo = _tkPhoto(master=master, width=columns, height=rows)
+            photo.writeBlock(0, 0, columns, pixels)
+            return photo
+    def now(self):
+        return time.time()*1000
+
+    # (Handle waiting events and due callbacks without blocking)
+    def pump(self, frame):
+        frame.update()
+        return True
+
+    # (Have the Tk thread call a function soon, from another thread, and say whether it will; Tkinter only hands calls over while mainloop() runs, so pumped windows find the work at their next pump)
+    def wake(self, frame, function):
+        if not _sys.looping:
+            return False
+        frame.after_idle(function)
+        return True
+
+# (Backend that draws into memory, with simulated time and no display)
+class _rasterBackend:
+    def __init__(self):
+        self.clock = 0.0 # Simulated milliseconds
+        self.events = [] # Heap of [time, order, function, args]
+        self.count = 0
+        self.limit = float(os.environ.get("INTROGRAPHICS_RUNTIME", "inf")) # Stop running after this time
+        self.pumped = None # Real milliseconds at the last pump
+        self.woken = deque() # Functions other threads asked to have called, not yet queued
+
+    def root(self):
+        return _rasterFrame(self, None)
+    def toplevel(self, root):
+        return _rasterFrame(self, root)
+    def canvas(self, frame):
+        return _rasterCanvas(frame)
+    def button(self, master, message):
+        return _rasterWidget("button", text=message)
+    def variable(self, master, message):
+        return _rasterVariable(message)
+    def entry(self, master, variable):
+        return _rasterWidget("entry", textvariable=variable)
+    def photo(self, master, filename):
+        return _rasterPhoto(filename)
+    def now(self):
+        return self.clock
+
+    # (Queue a callback for a later simulated time)
+    def after(self, milliseconds, function, args):
+        self.count += 1
+        event = [self.clock+max(int(milliseconds), 0), self.count, function, args]
+        heapq.heappush(self.events, event)
+        return event
+
+    # (Forget a queued callback)
+    def cancel(self, event):
+        event[2] = None
+
+    # (Advance simulated time by the real time since the last pump, running what falls due; say whether time remains)
+    def pump(self, frame):
+        now = time.time()*1000
+        if self.pumped is not None:
+            until = min(self.clock + now - self.pumped, self.limit)
+            self.run(frame, until)
+            self.clock = max(self.clock, until)
+        self.pumped = now
+        return self.clock < self.limit
+
+    # (Run queued callbacks in time order without waiting for the clock)
+    def run(self, frame, until=None):
+        events, woken = self.events, self.woken
+        if until is None:
+            until = self.limit
+        while True:
+            while woken:
+                self.after(0, woken.popleft(), ())
+            if not events or frame.destroyed or events[0][0] > until:
+                break
+            event = heapq.heappop(events)
+            if event[2] is not None:
+                self.clock = max(self.clock, event[0])
+                event[2](*event[3])
+
+    # (Have the run loop call a function soon, and say that it will; safe from other threads, since only the run loop touches the queue)
+    def wake(self, frame, function):
+        self.woken.append(function)
+        return True
+
+# (Stand-in for a Tk or Toplevel frame)
+class _rasterFrame:
+    def __init__(self, backend, master):
+        self.backend = backend
+        self.master = master
+        self.destroyed = False
+        self.bindings = {}
+        self.protocols = {}
+        self.title = ""
+        self.width, self.height = 1, 1
+
+    def withdraw(self):
+        pass
+    def deiconify(self):
+        pass
+    def update(self):
+        self.backend.run(self, self.backend.clock)
+    def mainloop(self):
+        self.backend.run(self)
+    def destroy(self):
+        self.destroyed = True
+    def protocol(self, name, function):
+        self.protocols[name] = function
+    def bind(self, sequence, function):
+        self.bindings[sequence] = function
+    def wm_title(self, title):
+        self.title = title
+    def wm_geometry(self, geometry):
+        size = geometry.split("+")[0].split("x")
+        self.width, self.height = int(size[0]), int(size[1])
+    def winfo_width(self):
+        return self.width
+    def winfo_height(self):
+        return self.height
+    def winfo_rgb(self, color):
+        return tuple([ord(c)*257 for c in _rasterRGB(color)])
+    def after(self, milliseconds, function, *args):
+        return self.backend.after(milliseconds, function, args)
+    def after_idle(self, function, *args):
+        return self.backend.after(0, function, args)
+    def after_cancel(self, event):
+        self.backend.cancel(event)
+
+# (Stand-in for a Tk StringVar)
+class _rasterVariable:
+    def __init__(self, value):
+        self.value = value
+    def get(self):
+        return self.value
+    def set(self, value):
+        self.value = value
+
+# (Stand-in for a Tk button or entry)
+class _rasterWidget:
+    def __init__(self, kind, **options):
+        self.kind = kind
+        self.options = options
+        self.bindings = {}
+
+    def config(self, **options):
+        self.options.update(options)
+    configure = config
+    def cget(self, option):
+        return self.options[option]
+    def bind(self, sequence, function):
+        self.bindings[sequence] = function
+
+    # (Get the text shown on this widget)
+    def message(self):
+        if "textvariable" in self.options:
+            return self.options["textvariable"].get()
+        return self.options.get("text", "")
+
+    # (Get the size of this widget in pixels)
+    def size(self):
+        if self.kind == "entry":
+            return (20*_rasterAdvance+8, 8+8)
+        return (len(self.message())*_rasterAdvance+16, 8+14)
+
+# (One item on a raster canvas)
+class _rasterItem:
+    def __init__(self, kind, coords, options, order):
+        self.kind = kind
+        self.coords = coords
+        self.options = options
+        self.tags = set()
+        self.order = order
+
+# (Stand-in for a Tk canvas that renders its items into a pixel buffer)
+class _rasterCanvas:
+    _defaults = {
+        "rectangle": {"fill":"", "outline":"black", "width":1},
+        "oval": {"fill":"", "outline":"black", "width":1},
+        "polygon": {"fill":"black", "outline":"", "width":1},
+        "line": {"fill":"black", "width":1},
+        "text": {"fill":"black", "font":("Helvetica",12), "text":""},
+        "window": {},
+        "image": {"image":None},
+    }
+
+    def __init__(self, master):
+        self.master = master
+        self.items = {} # id -> _rasterItem
+        self.count = 0
+        self.width, self.height = 1, 1
+        self.background = "#d9d9d9"
+
+    # (Create an item and return its id)
+    def _create(self, kind, coords, options):
+        if len(coords) == 1:
+            coords = coords[0]
+        self.count += 1
+        item = _rasterItem(kind, [float(c) for c in coords], dict(self._defaults[kind]), self.count)
+        self._configure(item, options)
+        self.items[self.count] = item
+        return self.count
+    def create_rectangle(self, *coords, **options):
+        return self._create("rectangle", coords, options)
+    def create_oval(self, *coords, **options):
+        return self._create("oval", coords, options)
+    def create_polygon(self, *coords, **options):
+        return self._create("polygon", coords, options)
+    def create_line(self, *coords, **options):
+        return self._create("line", coords, options)
+    def create_text(self, *coords, **options):
+        return self._create("text", coords, options)
+    def create_window(self, *coords, **options):
+        return self._create("window", coords, options)
+    def create_image(self, *coords, **options):
+        return self._create("image", coords, options)
+
+    # (Find the ids of the items with an id or tag)
+    def _find(self, tag):
+        if isinstance(tag, (int, long)):
+            return [tag] if tag in self.items else []
+        if tag == "all":
+            return self.items.keys()
+        return [i for (i, item) in self.items.iteritems() if tag in item.tags]
+
+    # (Update the options of an item)
+    def _configure(self, item, options):
+        if "tags" in options:
+            tags = options.pop("tags")
+            item.tags = set([tags] if isinstance(tags, basestring) else tags)
+        item.options.update(options)
+
+    def coords(self, tag, *coords):
+        if len(coords) == 1:
+            coords = coords[0]
+        ids = self._find(tag)
+        if not coords:
+            return tuple(self.items[ids[0]].coords) if ids else ()
+        for i in ids:
+            self.items[i].coords = [float(c) for c in coords]
+    def itemconfig(self, tag, **options):
+        for i in self._find(tag):
+            self._configure(self.items[i], dict(options))
+    itemconfigure = itemconfig
+    def itemcget(self, tag, option):
+        return str(self.items[self._find(tag)[0]].options.get(option, ""))
+    def delete(self, *tags):
+        for tag in tags:
+            for i in self._find(tag):
+                del self.items[i]
+    def addtag_withtag(self, newtag, tag):
+        for i in self._find(tag):
+            self.items[i].tags.add(newtag)
+    def dtag(self, tag, remove=None):
+        for i in self._find(tag):
+            self.items[i].tags.discard(tag if remove is None else remove)
+    def tag_raise(self, tag, above=None):
+        self._restack(tag, above, True)
+    def tag_lower(self, tag, below=None):
+        self._restack(tag, below, False)
+    def move(self, tag, dx, dy):
+        for i in self._find(tag):
+            coords = self.items[i].coords
+            coords[0::2] = [x+dx for x in coords[0::2]]
+            coords[1::2] = [y+dy for y in coords[1::2]]
+    def bbox(self, tag):
+        ids = self._find(tag)
+        if not ids:
+            return None
+        item = self.items[ids[0]]
+        x, y = int(item.coords[0]), int(item.coords[1])
+        if item.kind == "text":
+            scale = _rasterScale(item.options["font"])
+            lines = str(item.options["text"]).split("\n")
+            return (x, y, x+max(map(len, lines))*_rasterAdvance*scale, y+len(lines)*9*scale)
+        if item.kind == "window":
+            (width, height) = item.options["window"].size()
+            return (x, y, x+width, y+height)
+        if item.kind == "image":
+            photo = item.options["image"]
+            return (x, y, x+photo.width(), y+photo.height())
+        xs, ys = item.coords[0::2], item.coords[1::2]
+        return (int(min(xs)), int(min(ys)), int(max(xs))+1, int(max(ys))+1)
+    def configure(self, **options):
+        if "width" in options:
+            self.width = int(options["width"])
+        if "height" in options:
+            self.height = int(options["height"])
+        if "background" in options:
+            self.background = options["background"]
+    config = configure
+    def bind(self, sequence, function):
+        pass
+    def pack(self):
+        pass
+    def after(self, milliseconds, function, *args):
+        return self.master.after(milliseconds, function, *args)
+    def after_idle(self, function, *args):
+        return self.master.after_idle(function, *args)
+    def after_cancel(self, event):
+        self.master.after_cancel(event)
+
+    # (Put the items with a tag just above or below the items with another tag, or at the top or bottom)
+    def _restack(self, tag, other, up):
+        items = self.items
+        moving = set(self._find(tag))
+        stack = sorted([i for i in items if i not in moving], key=lambda i : items[i].order)
+        if other is None:
+            at = len(stack) if up else 0
+        else:
+            others = set(self._find(other))
+            places = [n for (n, i) in enumerate(stack) if i in others]
+            at = places[-1]+1 if up else places[0]
+        stack[at:at] = sorted(moving, key=lambda i : items[i].order)
+        for (n, i) in enumerate(stack):
+            items[i].order = n
+
+    # (Apply a list of queued operations)
+    def batch(self, ops):
+        items = self.items
+        for op in ops:
+            if op[0] == "coords":
+                items[op[1]].coords = list(op[2])
+            elif op[0] == "config":
+                for i in self._find(op[1]):
+                    self._configure(items[i], dict(op[2]))
+            elif op[0] == "place":
+                flat = op[2]
+                for (n, i) in enumerate(op[1]):
+                    x, y, size = flat[3*n:3*n+3]
+                    items[i].coords = [x, y, x+size, y+size]
+            elif op[0] == "fill":
+                for (i, color) in zip(op[1], op[2]):
+                    items[i].options["fill"] = color
+            elif op[0] == "move":
+                self.move(op[1], op[2], op[3])
+            elif op[0] == "insert":
+                items[op[1]].coords.extend(op[2])
+
+    # (Create many items and return their ids)
+    def createBatch(self, kind, count, tag):
+        return tuple([self._create(kind, (0,0,0,0), {"width":0, "tags":tag}) for i in xrange(count)])
+
+    # (Copy the items as they are now, so that another thread can render them; photos are shared, not copied)
+    def snapshot(self):
+        copy = _rasterCanvas(None)
+        (copy.width, copy.height, copy.background, copy.count) = (self.width, self.height, self.background, self.count)
+        for (key, item) in self.items.iteritems():
+            options = dict(item.options)
+            if item.kind == "window":
+                widget = options["window"]
+                options["window"] = _rasterWidget(widget.kind, text=widget.message())
+            copy.items[key] = _rasterItem(item.kind, list(item.coords), options, item.order)
+        return copy
+
+    # (Draw every item into a new buffer of r,g,b bytes)
+    def render(self):
+        width, height = self.width, self.height
+        pixels = bytearray(_rasterRGB(self.background)*(width*height))
+        for item in sorted(self.items.itervalues(), key=lambda item : item.order):
+            if item.options.get("state") != "hidden":
+                getattr(self, "_draw_"+item.kind)(pixels, item)
+        return pixels
+
+    # (Fill part of one row)
+    def _span(self, pixels, y, x1, x2, color):
+        if y < 0 or y >= self.height:
+            return
+        x1, x2 = max(int(x1), 0), min(int(x2), self.width)
+        if x1 < x2:
+            start = (y*self.width+x1)*3
+            pixels[start:start+(x2-x1)*3] = color*(x2-x1)
+
+    # (Draw a thick straight line)
+    def _segment(self, pixels, xa, ya, xb, yb, thickness, color):
+        steps = int(max(abs(xb-xa), abs(yb-ya), 1))
+        half = thickness//2
+        for i in xrange(steps+1):
+            x = int(round(xa+(xb-xa)*i/float(steps)))
+            y = int(round(ya+(yb-ya)*i/float(steps)))
+            for row in xrange(y-half, y-half+thickness):
+                self._span(pixels, row, x-half, x-half+thickness, color)
+
+    def _draw_rectangle(self, pixels, item):
+        (x1, y1, x2, y2) = [int(round(c)) for c in item.coords]
+        x1, x2, y1, y2 = min(x1, x2), max(x1, x2), min(y1, y2), max(y1, y2)
+        fill = _rasterRGB(item.options["fill"])
+        outline = _rasterRGB(item.options["outline"])
+        thickness = int(float(item.options["width"]))
+        if fill:
+            for y in xrange(y1, y2):
+                self._span(pixels, y, x1, x2, fill)
+        if outline and thickness > 0:
+            for y in xrange(y1, y2):
+                if y < y1+thickness or y >= y2-thickness:
+                    self._span(pixels, y, x1, x2, outline)
+                else:
+                    self._span(pixels, y, x1, x1+thickness, outline)
+                    self._span(pixels, y, x2-thickness, x2, outline)
+
+    def _draw_oval(self, pixels, item):
+        (x1, y1, x2, y2) = item.coords
+        x1, x2, y1, y2 = min(x1, x2), max(x1, x2), min(y1, y2), max(y1, y2)
+        fill = _rasterRGB(item.options["fill"])
+        outline = _rasterRGB(item.options["outline"])
+        thickness = int(float(item.options["width"]))
+        cx, cy, rx, ry = (x1+x2)/2.0, (y1+y2)/2.0, (x2-x1)/2.0, (y2-y1)/2.0
+        if rx <= 0 or ry <= 0:
+            return
+        for y in xrange(int(y1), int(math.ceil(y2))):
+            dy = (y+0.5-cy)/ry
+            if abs(dy) > 1:
+                continue
+            half = rx*math.sqrt(1-dy*dy)
+            if fill:
+                self._span(pixels, y, round(cx-half), round(cx+half), fill)
+            if outline and thickness > 0:
+                inner = 0
+                if rx > thickness and ry > thickness:
+                    dy = (y+0.5-cy)/(ry-thickness)
+                    if abs(dy) <= 1:
+                        inner = (rx-thickness)*math.sqrt(1-dy*dy)
+                if inner:
+                    self._span(pixels, y, round(cx-half), round(cx-inner), outline)
+                    self._span(pixels, y, round(cx+inner), round(cx+half), outline)
+                else:
+                    self._span(pixels, y, round(cx-half), round(cx+half), outline)
+
+    def _draw_polygon(self, pixels, item):
+        points = zip(item.coords[0::2], item.coords[1::2])
+        fill = _rasterRGB(item.options["fill"])
+        outline = _rasterRGB(item.options["outline"])
+        thickness = int(float(item.options["width"]))
+        if fill and len(points) > 2:
+            edges = zip(points, points[1:]+points[:1])
+            ys = [y for (x,y) in points]
+            for y in xrange(int(min(ys)), int(math.ceil(max(ys)))):
+                center = y+0.5
+                crossings = sorted([xa+(center-ya)*(xb-xa)/(yb-ya) for ((xa,ya),(xb,yb)) in edges
+                                    if (ya <= center < yb) or (yb <= center < ya)])
+                for i in xrange(0, len(crossings)-1, 2):
+                    self._span(pixels, y, round(crossings[i]), round(crossings[i+1]), fill)
+        if outline and thickness > 0:
+            for ((xa,ya),(xb,yb)) in zip(points, points[1:]+points[:1]):
+                self._segment(pixels, xa, ya, xb, yb, thickness, outline)
+
+    def _draw_line(self, pixels, item):
+        points = zip(item.coords[0::2], item.coords[1::2])
+        fill = _rasterRGB(item.options["fill"])
+        thickness = int(float(item.options["width"]))
+        if fill and thickness > 0:
+            for ((xa,ya),(xb,yb)) in zip(points, points[1:]):
+                self._segment(pixels, xa, ya, xb, yb, thickness, fill)
+
+    def _draw_text(self, pixels, item):
+        color = _rasterRGB(item.options["fill"])
+        if color:
+            self._write(pixels, int(item.coords[0]), int(item.coords[1]), str(item.options["text"]), _rasterScale(item.options["font"]), color)
+
+    def _draw_image(self, pixels, item):
+        photo = item.options["image"]
+        x, y = int(item.coords[0]), int(item.coords[1])
+        left, right = max(0, -x), min(photo.width(), self.width-x)
+        if left < right:
+            for row in xrange(max(0, -y), min(photo.height(), self.height-y)):
+                start = ((y+row)*self.width+x+left)*3
+                pixels[start:start+(right-left)*3] = photo.readBlock(left, row, right-left, 1)
+
+    def _draw_window(self, pixels, item):
+        widget = item.options["window"]
+        x, y = int(item.coords[0]), int(item.coords[1])
+        (width, height) = widget.size()
+        face = _rasterRGB("#d9d9d9" if widget.kind == "button" else "#fcfcfc")
+        border = _rasterRGB("black")
+        for row in xrange(y, y+height):
+            if row == y or row == y+height-1:
+                self._span(pixels, row, x, x+width, border)
+            else:
+                self._span(pixels, row, x, x+width, face)
+                self._span(pixels, row, x, x+1, border)
+                self._span(pixels, row, x+width-1, x+width, border)
+        self._write(pixels, x+4 if widget.kind == "entry" else x+8, y+4, widget.message(), 1, border)
+
+    # (Draw text with the built-in bitmap font)
+    def _write(self, pixels, x, y, message, scale, color):
+        top = y
+        for line in message.split("\n"):
+            left = x
+            for c in line:
+                glyph = _rasterGlyph(c)
+                for col in xrange(5):
+                    bits = glyph[col]
+                    for row in xrange(7):
+                        if bits >> row & 1:
+                            for dy in xrange(scale):
+                                self._span(pixels, top+row*scale+dy, left+col*scale, left+(col+1)*scale, color)
+                left += _rasterAdvance*scale
+            top += 9*scale
+
+# (Stand-in for a Tk photo image, holding its pixels in memory)
+class _rasterPhoto:
+    def __init__(self, filename=None, columns=0, rows=0):
+        if filename is None:
+            (self.columns, self.rows, self.data) = (columns, rows, bytearray(columns*rows*3))
+        else:
+            (self.columns, self.rows, self.data) = _readImage(filename)
+
+    def width(self):
+        return self.columns
+    def height(self):
+        return self.rows
+    def get(self, x, y):
+        i = (y*self.columns+x)*3
+        return "%d %d %d" % tuple(self.data[i:i+3])
+    def put(self, color, to):
+        (x, y) = to
+        i = (y*self.columns+x)*3
+        self.data[i:i+3] = _rasterRGB(color)
+
+    # (Read a block of pixels as r,g,b bytes)
+    def readBlock(self, col, row, width, height):
+        block = bytearray()
+        for y in xrange(row, row+height):
+            start = (y*self.columns+col)*3
+            block += self.data[start:start+width*3]
+        return block
+
+    # (Write a block of r,g,b bytes)
+    def writeBlock(self, col, row, width, buffer):
+        step = width*3
+        for (n, start) in enumerate(xrange(0, len(buffer), step)):
+            i = ((row+n)*self.columns+col)*3
+            self.data[i:i+step] = buffer[start:start+step]
+
+    # (Copy a block into a new photo)
+    def slice(self, col, row, width, height):
+        photo = _rasterPhoto(None, width, height)
+        photo.data = self.readBlock(col, row, width, height)
+        return photo
+
+    # (Copy the whole photo into a new one)
+    def copy(self):
+        return self.slice(0, 0, self.columns, self.rows)
+
+    # (Make a new empty photo)
+    def blank(self, width, height):
+        return _rasterPhoto(None, width, height)
+
+    # (Save to a file in the format its name ends with)
+    def saveAs(self, filename):
+        _writeImage(filename, self.columns, self.rows, _reader(self.data, self.columns))
+
+# (Named colors known without Tk, with their X11 values)
+_rasterColors = {
+    "black":"000000", "white":"ffffff", "red":"ff0000", "green":"00ff00", "blue":"0000ff",
+    "yellow":"ffff00", "cyan":"00ffff", "magenta":"ff00ff", "gray":"bebebe", "grey":"bebebe",
+    "orange":"ffa500", "purple":"a020f0", "brown":"a52a2a", "pink":"ffc0cb", "navy":"000080",
+    "maroon":"b03060", "olive":"808000", "teal":"008080", "silver":"c0c0c0", "gold":"ffd700",
+    "violet":"ee82ee", "indigo":"4b0082", "turquoise":"40e0d0", "tan":"d2b48c", "salmon":"fa8072",
+    "coral":"ff7f50", "khaki":"f0e68c", "orchid":"da70d6", "beige":"f5f5dc", "ivory":"fffff0",
+    "lavender":"e6e6fa", "crimson":"dc143c", "chocolate":"d2691e", "tomato":"ff6347",
+    "skyblue":"87ceeb", "sky blue":"87ceeb", "lightblue":"add8e6", "light blue":"add8e6",
+    "darkblue":"00008b", "dark blue":"00008b", "lightgreen":"90ee90", "light green":"90ee90",
+    "darkgreen":"006400", "dark green":"006400", "lightgray":"d3d3d3", "light gray":"d3d3d3",
+    "lightgrey":"d3d3d3", "darkgray":"a9a9a9", "dark gray":"a9a9a9", "darkgrey":"a9a9a9",
+    "darkred":"8b0000", "dark red":"8b0000", "forestgreen":"228b22", "forest green":"228b22",
+    "limegreen":"32cd32", "lime green":"32cd32", "royalblue":"4169e1", "royal blue":"4169e1",
+    "steelblue":"4682b4", "steel blue":"4682b4", "firebrick":"b22222", "goldenrod":"daa520",
+    "sienna":"a0522d", "plum":"dda0dd", "aquamarine":"7fffd4", "chartreuse":"7fff00",
+    "hotpink":"ff69b4", "hot pink":"ff69b4", "deeppink":"ff1493", "deep pink":"ff1493",
+    "midnightblue":"191970", "midnight blue":"191970", "slategray":"708090", "slate gray":"708090",
+}
+
+# (Convert a Tk color name or #rgb/#rrggbb string to 3 bytes, or "" for no color)
+def _rasterRGB(color, cache={}):
+    try:
+        return cache[color]
+    except KeyError:
+        pass
+    name = str(color).strip().lower()
+    if name == "":
+        value = ""
+    elif name.startswith("#") and len(name) in [4, 7]:
+        digits = name[1:] if len(name) == 7 else "".join([c*2 for c in name[1:]])
+        value = binascii.unhexlify(digits)
+    elif name.rstrip("0123456789") in ["gray", "grey"] and name[4:].isdigit():
+        value = chr(int(round(int(name[4:])*2.55)))*3
+    elif name in _rasterColors:
+        value = binascii.unhexlify(_rasterColors[name])
+    else:
+        raise ValueError("Unknown color: "+str(color))
+    cache[color] = value
+    return value
+
+# (5x7 bitmap font for printable ASCII; five column bytes per character, low bit on top)
+_rasterFont = binascii.unhexlify(
+    "0000000000" "00005f0000" "0007000700" "147f147f14" "242a7f2a12" "2313086462" "3649552250" "0005030000"
+    "001c224100" "0041221c00" "082a1c2a08" "08083e0808" "0050300000" "0808080808" "0060600000" "2010080402"
+    "3e5149453e" "00427f4000" "4261514946" "2141454b31" "1814127f10" "2745454539" "3c4a494930" "0171090503"
+    "3649494936" "064949291e" "0036360000" "0056360000" "0814224100" "1414141414" "0041221408" "0201510906"
+    "324979413e" "7e1111117e" "7f49494936" "3e41414122" "7f4141221c" "7f49494941" "7f09090101" "3e41415132"
+    "7f0808087f" "00417f4100" "2040413f01" "7f08142241" "7f40404040" "7f0204027f" "7f0408107f" "3e4141413e"
+    "7f09090906" "3e4151215e" "7f09192946" "4649494931" "01017f0101" "3f4040403f" "1f2040201f" "7f2018207f"
+    "6314081463" "0304780403" "6151494543" "00007f4141" "0204081020" "41417f0000" "0402010204" "4040404040"
+    "0001020400" "2054545478" "7f48444438" "3844444420" "384444487f" "3854545418" "087e090102" "081454543c"
+    "7f08040478" "00447d4000" "2040443d00" "007f102844" "00417f4000" "7c0418047c" "7c08040478" "3844444438"
+    "7c14141408" "081414187c" "7c08040408" "4854545420" "043f444020" "3c4040207c" "1c2040201c" "3c4030403c"
+    "4428102844" "0c5050503c" "4464544c44" "0008364100" "00007f0000" "0041360800" "0201020402")
+
+_rasterAdvance = 6 # Pixels from one character to the next at scale 1
+
+# (Get the five column bytes for a character)
+def _rasterGlyph(c):
+    code = ord(c)
+    if code < 32 or code > 126:
+        code = ord("?")
+    start = (code-32)*5
+    return bytearray(_rasterFont[start:start+5])
+
+# (Get the pixel scale for a Tk font description)
+def _rasterScale(font):
+    try:
+        size = int(font[1]) if isinstance(font, tuple) else int(str(font).split()[1])
+    except (IndexError, ValueError):
+        size = 12
+    return max(1, int(round(abs(size)/8.0)))
+
+#########################################################################
+# Image files
+#########################################################################
+
+# (Read a GIF, PNG, PPM or PGM file into (columns, rows, r,g,b bytearray))
+def _readImage(filename):
+    with open(filename, "rb") as f:
+        magic = f.read(8)
+        if magic[:2] in ["P2", "P3", "P5", "P6"]:
+            return _readPNM(f)
+        data = magic+f.read()
+    if data[:6] in ["GIF87a", "GIF89a"]:
+        return _readGIF(data)
+    if data[:8] == "\x89PNG\r\n\x1a\n":
+        return _readPNG(data)
+    raise IOError("Unsupported image format: "+filename)
+
+# (Rows read, converted or written at a time, so big images never pass through as one string)
+_bandRows = 64
+
+# (Get the image format a file name asks for: "png", "ppm", "pgm", or else "gif")
+def _imageFormat(filename):
+    kind = os.path.splitext(filename)[1].lower()[1:]
+    return kind if kind in ["png", "ppm", "pgm"] else "gif"
+
+# (Make a function that reads bands of rows from r,g,b bytes)
+def _reader(pixels, columns):
+    stride = columns*3
+    return lambda row, count : pixels[row*stride:(row+count)*stride]
+
+# (Write an image file in the format its name asks for, getting bands of rows from read(row, count))
+def _writeImage(filename, columns, rows, read):
+    kind = _imageFormat(filename)
+    if kind == "png":
+        _writePNG(filename, columns, rows, read)
+    elif kind == "gif":
+        _writeGIF(filename, columns, rows, read(0, rows))
+    else:
+        _writePNM(filename, columns, rows, read, kind == "pgm")
+
+# (Decode a PPM or PGM file, mapping the pixels of binary files instead of reading them in)
+def _readPNM(f):
+    f.seek(0)
+    view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        fields = []
+        position = 0
+        while len(fields) < 4:
+            while view[position].isspace():
+                position += 1
+            if view[position] == "#":
+                position = view.find("\n", position)
+                if position < 0:
+                    raise IOError("Unsupported PPM or PGM image")
+                continue
+            end = position
+            while end < len(view) and not view[end].isspace():
+                end += 1
+            fields.append(view[position:end])
+            position = end
+        (kind, columns, rows, maximum) = (fields[0], int(fields[1]), int(fields[2]), int(fields[3]))
+        channels = 3 if kind in ["P3", "P6"] else 1
+        count = columns*rows*channels
+        if kind in ["P5", "P6"]:
+            size = 2 if maximum > 255 else 1
+            samples = bytearray(view[position+1:position+1+count*size])
+            if size == 2:
+                samples = [(samples[i] << 8 | samples[i+1])*255//maximum for i in xrange(0, len(samples), 2)]
+                samples = bytearray(samples)
+            elif maximum != 255:
+                samples = samples.translate(bytearray([min(v*255//maximum, 255) for v in xrange(256)]))
+        else:
+            samples = bytearray([min(int(v)*255//maximum, 255) for v in view[position:].split()[:count]])
+    finally:
+        view.close()
+    samples += bytearray(count-len(samples))
+    if channels == 1:
+        pixels = bytearray(count*3)
+        pixels[0::3] = pixels[1::3] = pixels[2::3] = samples
+        return (columns, rows, pixels)
+    return (columns, rows, samples)
+
+# (Write a binary PPM file, or a PGM file of the pixels' brightness)
+def _writePNM(filename, columns, rows, read, gray=False):
+    with open(filename, "wb") as f:
+        f.write("%s\n%d %d\n255\n" % ("P5" if gray else "P6", columns, rows))
+        for top in xrange(0, rows, _bandRows):
+            band = read(top, min(_bandRows, rows-top))
+            if gray:
+                band = bytearray([(299*r+587*g+114*b+500)//1000 for (r, g, b) in zip(band[0::3], band[1::3], band[2::3])])
+            f.write(band)
+
+# (Decode a PNG, undoing the filter on each row as it comes out of the decompressor)
+def _readPNG(data):
+    (columns, rows, depth, kind, compression, method, interlace) = struct.unpack(">IIBBBBB", data[16:29])
+    if interlace or depth not in [1, 2, 4, 8, 16] or kind not in [0, 2, 3, 4, 6]:
+        raise IOError("Unsupported PNG image")
+    channels = {0:1, 2:3, 3:1, 4:2, 6:4}[kind]
+    unit = max(1, channels*depth//8) # Bytes per pixel, for the filters
+    stride = (columns*channels*depth+7)//8
+    palette = None
+    inflater = zlib.decompressobj()
+    pending = bytearray()
+    prior = bytearray(stride)
+    pixels = bytearray()
+    position = 8
+    while position+8 <= len(data):
+        (size, chunk) = struct.unpack(">I4s", data[position:position+8])
+        body = data[position+8:position+8+size]
+        position += size+12
+        if chunk == "PLTE":
+            palette = body
+        elif chunk == "IDAT":
+            pending += inflater.decompress(body)
+            while len(pending) > stride and len(pixels) < columns*rows*3:
+                line = _pngUnfilter(pending[0], pending[1:stride+1], prior, unit)
+                del pending[:stride+1]
+                pixels += _pngRow(line, columns, kind, depth, palette)
+                prior = line
+        elif chunk == "IEND":
+            break
+    pixels += bytearray("\xff"*(columns*rows*3-len(pixels)))
+    return (columns, rows, pixels)
+
+# (Undo the filter on one row of a PNG, given the row above)
+def _pngUnfilter(kind, line, prior, unit):
+    if kind == 1:
+        for i in xrange(unit, len(line)):
+            line[i] = (line[i]+line[i-unit]) & 0xff
+    elif kind == 2:
+        line = bytearray([(a+b) & 0xff for (a, b) in zip(line, prior)])
+    elif kind == 3:
+        for i in xrange(len(line)):
+            line[i] = (line[i]+((line[i-unit] if i >= unit else 0)+prior[i])//2) & 0xff
+    elif kind == 4:
+        for i in xrange(len(line)):
+            a = line[i-unit] if i >= unit else 0
+            b = prior[i]
+            c = prior[i-unit] if i >= unit else 0
+            p = a+b-c
+            pa, pb, pc = abs(p-a), abs(p-b), abs(p-c)
+            line[i] = (line[i]+(a if pa <= pb and pa <= pc else b if pb <= pc else c)) & 0xff
+    return line
+
+# (Turn one unfiltered PNG row into r,g,b bytes; alpha is blended onto white)
+def _pngRow(line, columns, kind, depth, palette):
+    if depth == 16:
+        line = line[0::2]
+    elif depth < 8:
+        per = 8//depth
+        mask = (1 << depth)-1
+        line = bytearray([byte >> (8-depth*(k+1)) & mask for byte in line for k in xrange(per)][:columns])
+        if kind == 0:
+            line = line.translate(bytearray([min(v*255//mask, 255) for v in xrange(256)]))
+    if kind == 3:
+        colors = bytearray(palette)+bytearray(768-len(palette))
+        result = bytearray(len(line)*3)
+        for channel in xrange(3):
+            result[channel::3] = line.translate(colors[channel::3])
+        return result
+    channels = {0:1, 2:3, 4:2, 6:4}[kind]
+    alpha = line[channels-1::channels] if kind in [4, 6] else None
+    result = bytearray(columns*3)
+    for channel in xrange(3):
+        values = line[(channel if kind in [2, 6] else 0)::channels]
+        if alpha is not None:
+            values = bytearray([(v*a+255*(255-a)+127)//255 for (v, a) in zip(values, alpha)])
+        result[channel::3] = values
+    return result
+
+# (Decode the first frame of a GIF)
+def _readGIF(data):
+    (width, height, flags) = struct.unpack("<HHB", data[6:11])
+    background = ord(data[11])
+    position = 13
+    palette = None
+    if flags & 0x80:
+        size = 3 << ((flags & 7)+1)
+        palette = data[position:position+size]
+        position += size
+    transparent = None
+    while position < len(data):
+        kind = data[position]
+        if kind == "!":
+            if data[position+1] == "\xf9" and ord(data[position+3]) & 1:
+                transparent = ord(data[position+6])
+            position += 2
+            while data[position] != "\x00":
+                position += ord(data[position])+1
+            position += 1
+        elif kind == ",":
+            (left, top, columns, rows, flags) = struct.unpack("<HHHHB", data[position+1:position+10])
+            position += 10
+            if flags & 0x80:
+                size = 3 << ((flags & 7)+1)
+                palette = data[position:position+size]
+                position += size
+            codeSize = ord(data[position])
+            position += 1
+            blocks = []
+            while data[position] != "\x00":
+                size = ord(data[position])
+                blocks.append(data[position+1:position+1+size])
+                position += size+1
+            indices = _lzwDecode("".join(blocks), codeSize)[:columns*rows]
+            indices += "\x00"*(columns*rows-len(indices))
+            if flags & 0x40:
+                order = range(0, rows, 8)+range(4, rows, 8)+range(2, rows, 4)+range(1, rows, 2)
+                lines = [None]*rows
+                for (n, row) in enumerate(order):
+                    lines[row] = indices[n*columns:(n+1)*columns]
+                indices = "".join(lines)
+            colors = [palette[3*i:3*i+3] if 3*i+3 <= len(palette) else "\x00\x00\x00" for i in xrange(256)]
+            if transparent is not None:
+                colors[transparent] = "\xff\xff\xff"
+            pixels = bytearray("\xff\xff\xff"*(width*height))
+            for row in xrange(min(rows, height-top)):
+                line = "".join(map(colors.__getitem__, map(ord, indices[row*columns:(row+1)*columns])))
+                start = ((top+row)*width+left)*3
+                pixels[start:start+min(len(line), (width-left)*3)] = line[:(width-left)*3]
+            return (width, height, pixels)
+        else:
+            break
+    return (width, height, bytearray("\xff\xff\xff"*(width*height)))
+
+# (Decompress GIF image data into a string of palette indices)
+def _lzwDecode(data, codeSize):
+    clear = 1 << codeSize
+    table = [chr(i) for i in xrange(clear)]+[None, None]
+    size = codeSize+1
+    output = []
+    previous = None
+    accumulator, bits = 0, 0
+    for byte in bytearray(data):
+        accumulator |= byte << bits
+        bits += 8
+        while bits >= size:
+            code = accumulator & ((1 << size)-1)
+            accumulator >>= size
+            bits -= size
+            if code == clear:
+                del table[clear+2:]
+                size = codeSize+1
+                previous = None
+                continue
+            if code == clear+1:
+                return "".join(output)
+            if code < len(table):
+                entry = table[code]
+                if previous is not None:
+                    table.append(previous+entry[0])
+            else:
+                entry = previous+previous[0]
+                table.append(entry)
+            output.append(entry)
+            previous = entry
+            if len(table) == 1 << size and size < 12:
+                size += 1
+    return "".join(output)
+
+# (Compress a string of palette indices into GIF image data)
+def _lzwEncode(indices, codeSize):
+    clear = 1 << codeSize
+    output = bytearray()
+    state = [0, 0, codeSize+1] # Pending bits, pending bit count, code size
+    def emit(code):
+        state[0] |= code << state[1]
+        state[1] += state[2]
+        while state[1] >= 8:
+            output.append(state[0] & 0xff)
+            state[0] >>= 8
+            state[1] -= 8
+    table = dict((chr(i), i) for i in xrange(clear))
+    following = clear+2
+    emit(clear)
+    word = ""
+    for c in indices:
+        extended = word+c
+        if extended in table:
+            word = extended
+            continue
+        emit(table[word])
+        if following < 4096:
+            table[extended] = following
+            if following == 1 << state[2]:
+                state[2] += 1
+            following += 1
+        else:
+            emit(clear)
+            table = dict((chr(i), i) for i in xrange(clear))
+            following = clear+2
+            state[2] = codeSize+1
+        word = c
+    if word:
+        emit(table[word])
+    emit(clear+1)
+    if state[1] > 0:
+        output.append(state[0] & 0xff)
+    return str(output)
+
+# (Map r,g,b bytes onto a palette of at most 256 colors; return (palette, indices))
+def _quantize(pixels):
+    colors = {}
+    for i in xrange(0, len(pixels), 3):
+        color = str(pixels[i:i+3])
+        if color not in colors:
+            if len(colors) == 256:
+                break
+            colors[color] = chr(len(colors))
+    else:
+        indices = "".join([colors[str(pixels[i:i+3])] for i in xrange(0, len(pixels), 3)])
+        palette = [None]*len(colors)
+        for (color, index) in colors.iteritems():
+            palette[ord(index)] = color
+        return ("".join(palette), indices)
+    return (_gifPalette, _quantizeFixed(pixels))
+
+# (A fixed 6x7x6 color cube for pictures with too many colors)
+_gifPalette = "".join([chr(r*255//5)+chr(g*255//6)+chr(b*255//5) for r in xrange(6) for g in xrange(7) for b in xrange(6)])
+
+# (Each channel's share of a color cube index, as translate tables)
+_cubeShares = ("".join([chr(((v*6)>>8)*42) for v in xrange(256)]), "".join([chr(((v*7)>>8)*6) for v in xrange(256)]), "".join([chr((v*6)>>8) for v in xrange(256)]))
+
+# (Map r,g,b bytes onto the fixed color cube)
+def _quantizeFixed(pixels):
+    data = bytearray(pixels)
+    count = len(data)//3
+    if _numpy is not None:
+        values = _numpy.frombuffer(data, _numpy.uint8)
+        shares = [_numpy.frombuffer(table, _numpy.uint8)[values[k::3]] for (k, table) in enumerate(_cubeShares)]
+        return (shares[0]+shares[1]+shares[2]).tostring()
+    # Translate each channel to its share, then add the three as big numbers; shares sum to at most 251, so no byte carries
+    total = sum([int(binascii.hexlify(data[k::3].translate(table)), 16) for (k, table) in enumerate(_cubeShares)])
+    return binascii.unhexlify("%0*x" % (2*count, total))
+
+# (Write a single-frame GIF)
+def _writeGIF(filename, columns, rows, pixels):
+    (palette, indices) = _quantize(pixels)
+    with open(filename, "wb") as f:
+        f.write(_gifHeader(columns, rows, palette))
+        f.write(_gifFrame(0, 0, columns, rows, indices, palette))
+        f.write(";")
+
+# (Build a GIF file header with a global palette)
+def _gifHeader(columns, rows, palette):
+    bits = max(1, int(math.ceil(math.log(max(len(palette)//3, 2), 2))))
+    palette += "\x00"*(3*(1 << bits)-len(palette))
+    return "GIF89a"+struct.pack("<HHBBB", columns, rows, 0xf0 | (bits-1), 0, 0)+palette
+
+# (Build one GIF image block using the global palette)
+def _gifFrame(left, top, columns, rows, indices, palette, delay=None):
+    block = ""
+    if delay is not None:
+        block += "!\xf9\x04"+struct.pack("<BHB", 0x04, int(delay), 0)+"\x00"
+    codeSize = max(2, int(math.ceil(math.log(max(len(palette)//3, 2), 2))))
+    data = _lzwEncode(indices, codeSize)
+    block += ","+struct.pack("<HHHHB", left, top, columns, rows, 0)+chr(codeSize)
+    block += "".join([chr(len(data[i:i+255]))+data[i:i+255] for i in xrange(0, len(data), 255)])
+    return block+"\x00"
+
+# (Write a PNG file, compressing one band of rows at a time from read(row, count))
+def _writePNG(filename, columns, rows, read):
+    stride = columns*3
+    deflater = zlib.compressobj(6)
+    with open(filename, "wb") as f:
+        f.write("\x89PNG\r\n\x1a\n")
+        f.write(_pngChunk("IHDR", struct.pack(">IIBBBBB", columns, rows, 8, 2, 0, 0, 0)))
+        for top in xrange(0, rows, _bandRows):
+            band = read(top, min(_bandRows, rows-top))
+            data = deflater.compress("".join(["\x00"+str(band[start:start+stride]) for start in xrange(0, len(band), stride)]))
+            if data:
+                f.write(_pngChunk("IDAT", data))
+        f.write(_pngChunk("IDAT", deflater.flush()))
+        f.write(_pngChunk("IEND", ""))
+
+# (Build one PNG chunk)
+def _pngChunk(kind, data):
+    return struct.pack(">I", len(data))+kind+data+struct.pack(">I", zlib.crc32(kind+data) & 0xffffffff)
+
+# (Find the smallest (left, top, width, height) holding every pixel that changed, or None)
+def _difference(before, after, columns):
+    if before == after:
+        return None
+    stride = columns*3
+    top, bottom = 0, len(after)//stride
+    while before[top*stride:(top+1)*stride] == after[top*stride:(top+1)*stride]:
+        top += 1
+    while before[(bottom-1)*stride:bottom*stride] == after[(bottom-1)*stride:bottom*stride]:
+        bottom -= 1
+    left, right = columns, 0
+    for row in xrange(top, bottom):
+        a = before[row*stride:(row+1)*stride]
+        b = after[row*stride:(row+1)*stride]
+        if a == b:
+            continue
+        low, high = 0, left # Leftmost change is at or after low and before high
+        while low < high:
+            middle = (low+high+1)//2
+            if a[:middle*3] == b[:middle*3]:
+                low = middle
+            else:
+                high = middle-1
+        left = low
+        low, high = right, columns # Rightmost change ends after low and at or before high
+        while low < high:
+            middle = (low+high)//2
+            if a[middle*3:] == b[middle*3:]:
+                high = middle
+            else:
+                low = middle+1
+        right = low
+    return (left, top, right-left, bottom-top)
+
+# (Writes recorded frames on a background thread, so encoding doesn't hold up the timers)
+class _recorder(threading.Thread):
+    def __init__(self, path, columns, rows, fps, frames):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.columns, self.rows = columns, rows
+        self.fps = fps
+        self.frames = frames
+        self.captured = 0 # Frames sent so far
+        self.dropped = 0 # Frames not sent because the writer was behind
+        self.skipped = 0 # Of those, the ones since the last frame sent
+        self.written = 0 # Frame times written so far, counting repeats
+        self.queue = Queue.Queue(8) # (canvas snapshot, frames skipped before it) waiting to be drawn and written; no snapshot at the end
+        self.pixels = None # The whole latest frame
+        self.failure = None
+
+    # (Draw each snapshot, find the rectangle that changed, and write it; skipped frames repeat the one before)
+    def run(self):
+        try:
+            self.begin()
+            while True:
+                (canvas, skipped) = self.queue.get()
+                if skipped:
+                    self.repeat(skipped)
+                    self.written += skipped
+                if canvas is None:
+                    break
+                pixels = canvas.render()
+                box = (0, 0, self.columns, self.rows) if self.pixels is None else _difference(self.pixels, pixels, self.columns)
+                self.pixels = pixels
+                if box is None:
+                    self.repeat(1)
+                else:
+                    (left, top, width, height) = box
+                    stride = self.columns*3
+                    block = "".join([str(pixels[row*stride+left*3:row*stride+(left+width)*3]) for row in xrange(top, top+height)])
+                    self.write(left, top, width, height, block)
+                self.written += 1
+            self.end()
+        except Exception, failure:
+            self.failure = failure
+            while self.queue.get()[0] is not None:
+                pass
+
+    def begin(self):
+        pass
+    def end(self):
+        pass
+
+# (Records an animated GIF, storing only the changed rectangle of each frame)
+class _gifRecorder(_recorder):
+    def begin(self):
+        self.file = open(self.path, "wb")
+        self.file.write(_gifHeader(self.columns, self.rows, _gifPalette))
+        self.file.write("!\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00") # Loop forever
+        self.held = None # Latest frame and when it started, held back until its delay is known
+    def write(self, left, top, width, height, block):
+        self.release()
+        self.held = (left, top, width, height, _quantizeFixed(block), self.written)
+    def repeat(self, count):
+        pass # The held frame just stays up longer
+    def release(self):
+        if self.held is not None:
+            (left, top, width, height, indices, start) = self.held
+            delay = int(round(self.written*100/self.fps))-int(round(start*100/self.fps))
+            self.file.write(_gifFrame(left, top, width, height, indices, _gifPalette, delay))
+    def end(self):
+        self.release()
+        self.file.write(";")
+        self.file.close()
+
+# (Records numbered PNG files, like "frame0000.png" or a pattern like "frame%03d.png")
+class _pngRecorder(_recorder):
+    def name(self, number):
+        path = self.path
+        if "%" not in path:
+            path = path[:-4]+"%04d"+path[-4:]
+        return path % number
+    def write(self, left, top, width, height, block):
+        _writePNG(self.name(self.written), self.columns, self.rows, _reader(self.pixels, self.columns))
+    def repeat(self, count):
+        for number in xrange(self.written, self.written+count):
+            shutil.copyfile(self.name(self.written-1), self.name(number))
+
+# (Records raw r,g,b frames, e.g. for ffmpeg -f rawvideo -pix_fmt rgb24)
+class _rawRecorder(_recorder):
+    def begin(self):
+        self.file = sys.stdout if self.path == "-" else open(self.path, "wb")
+    def write(self, left, top, width, height, block):
+        self.file.write(self.pixels)
+    def repeat(self, count):
+        for i in xrange(count):
+            self.file.write(self.pixels)
+    def end(self):
+        self.file.flush()
+        if self.file is not sys.stdout:
+            self.file.close()
+
+# (Available backends by name)
+_backends = {"tk":_tkBackend, "headless":_rasterBackend}
+
 # (Initialize tools)
 _sys = _system()
 
+# Choose where new windows are drawn: "tk" (the default) or "headless"
+def useBackend(name=None, *extra):
+    command = "intrographics.useBackend(name)"
+    if len(extra) > 0:
+        return _sys.extra(command)
+    if name==None:
+        return _sys.missing(command)
+    if name not in _backends:
+        return _sys.restricted(command)
+    if name == "tk" and Tkinter is None:
+        return _sys.error("The tk backend needs Tkinter, which this Python doesn't have.")
+    if _sys.root:
+        return _sys.error("Can't change the backend while windows are open.")
+    _sys.backend = _backends[name]()
+
 # A simple graphical display
 class window:
+    _catchup = 4 # Most times a late timer may run to catch up in one frame
+    _heartbeat = 20 # Most milliseconds between frames while posted work or handler generators wait
+
     def __init__(self, width=None, height=None, *extra):
         command = "intrographics.window(width,height)"
         if len(extra) > 0:
@@ -99,16 +1677,42 @@ class window:
             return _sys.restricted(command)
         width = width + 1
         height = height + 1
-        self._shapes = []
-        self._timers = []
+        self._shapes = OrderedDict() # Canvas id -> shape, in the order they were added
+        self._index = _grid()
+        self._groups = {}
+        self._layers = {} # Name -> layer
+        self._batches = set()
+        self._count = 0
+        self._timers = {} # function -> list of its scheduled entries
+        self._schedule = [] # Heap of [deadline, order, milliseconds, function, active]
+        self._pending = None # Tk callback id for the next frame
+        self._pendingAt = None # Deadline the next frame was scheduled for
+        self._dirty = set() # Shapes with changes not yet sent to Tk
+        self._flushing = False # Whether a flush is already scheduled
+        self._frames = {"frames":0, "lag":0.0, "maxLag":0.0, "totalLag":0.0, "work":0.0, "overruns":0, "dropped":0, "unrecorded":0}
+        self._clock = None # Simulated time while simulate() runs
+        self._skew = 0.0 # Simulated time gained over the backend clock
+        self._handlers = {} # Input kind -> handler function
+        self._posted = deque() # (function, arguments) posted from any thread, run at the next frame
+        self._thread = threading.current_thread() # Thread that owns the frame and canvas
+        self._waking = False # Whether another thread has asked the backend to wake this window
+        self._tasks = [] # Generators returned by handlers, stepped once a frame
+        self._futures = set() # trollius tasks running handler generators while an event loop runs
+        self._recording = None # (recorder, schedule entry) while recording
+        self._profile = None # Profiler while profiling
         self._opened = False
         self._closed = False
+        self._trusted = False
         self._frame = _sys.createFrame(self)
-        self._canvas = Tkinter.Canvas(self._frame)
+        self._canvas = _sys.backend.canvas(self._frame)
         self._configure(0, 0, width, height)
         self._frame.protocol("WM_DELETE_WINDOW", lambda : self.close(""))
         self._canvas.bind("<Configure>", lambda event : self._configure(self._x, self._y, self._frame.winfo_width(), self._frame.winfo_height()))
         self.fill("white")
+        if _sys.trusted:
+            self.optimize()
+        if _sys.profile not in ["", "0"]:
+            self.profile(True, _sys.profile == "hud")
 
     # (Update the window location and/or size)
     def _configure(self, x, y, width, height):
@@ -289,39 +1893,226 @@ class window:
             return _sys.invalid(command)
         if self._closed:
             return None
-        return self._add(image(self._canvas, x, y, filename))
+        return self._add(image(self._canvas, x, y, _sys.photo(filename)))
+
+    # Add and return a sprite showing one frame of a sprite sheet
+    def addSprite(self, x=None, y=None, sheet=None, frame=0, *extra):
+        command = "window.addSprite(x,y,sheet,frame?)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if x==None or y==None or sheet==None:
+            return _sys.missing(command)
+        try:
+            x, y, frame = int(x), int(y), int(frame)
+            frames = sheet._slice()
+        except (ValueError, AttributeError):
+            return _sys.invalid(command)
+        if frame < 0 or frame >= len(frames):
+            return _sys.restricted(command)
+        if self._closed:
+            return None
+        return self._add(sprite(self._canvas, x, y, sheet, frame))
+
+    # Add and return a plot that shows the latest values pushed into it
+    def addPlot(self, x=None, y=None, width=None, height=None, capacity=None, *extra):
+        command = "window.addPlot(x,y,width,height,capacity?)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if x==None or y==None or width==None or height==None:
+            return _sys.missing(command)
+        try:
+            x, y, width, height = int(x), int(y), int(width), int(height)
+            capacity = width if capacity==None else int(capacity)
+        except ValueError:
+            return _sys.invalid(command)
+        if width < 1 or height < 1 or capacity < 1:
+            return _sys.restricted(command)
+        if self._closed:
+            return None
+        return self._add(plot(self._canvas, x, y, width, height, capacity))
+
+    # Skip argument checking in the busiest methods of this window and its shapes
+    def optimize(self, enabled=True, *extra):
+        command = "window.optimize(enabled?)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        enabled = bool(enabled)
+        if self._closed or enabled == self._trusted:
+            return
+        self._trusted = enabled
+        for name in ["addRectangle", "addOval", "addPolygon", "addLine"]:
+            if enabled:
+                self.__dict__[name] = getattr(self, "_lean"+name[0].upper()+name[1:])
+            else:
+                del self.__dict__[name]
+        for obj in self._shapes.itervalues():
+            obj.__class__ = _leanClass(obj.__class__, enabled)
+
+    # (Lean versions of the add methods, for optimized windows)
+    def _leanAddRectangle(self, x, y, width, height):
+        if not self._closed:
+            return self._add(rectangle(self._canvas, x, y, width, height))
+    def _leanAddOval(self, x, y, width, height):
+        if not self._closed:
+            return self._add(oval(self._canvas, x, y, width, height))
+    def _leanAddPolygon(self, *points):
+        if not self._closed:
+            return self._add(polygon(self._canvas, points))
+    def _leanAddLine(self, *points):
+        if not self._closed:
+            return self._add(line(self._canvas, points))
+
+    # Add and return a batch of many small moving shapes
+    def addParticles(self, count=None, kind="oval", size=4, *extra):
+        command = "window.addParticles(count,kind?,size?)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if count==None:
+            return _sys.missing(command)
+        try:
+            count, kind, size = int(count), str(kind), int(size)
+        except ValueError:
+            return _sys.invalid(command)
+        if count < 1 or size < 1 or kind not in ["oval", "rectangle"]:
+            return _sys.restricted(command)
+        if self._closed:
+            return None
+        batch = particles(self._canvas, count, kind, size)
+        batch._window = self
+        self._batches.add(batch)
+        return batch
 
     # (Add and return a shape)
     def _add(self, obj):
-        self._shapes.append(obj)
+        if self._trusted:
+            obj.__class__ = _leanClass(obj.__class__, True)
+        obj._window = self
+        obj._order = self._count
+        self._count += 1
+        self._shapes[obj._id] = obj
+        self._index.update(obj)
+        if hasattr(obj, "_group"):
+            self._regroup(obj, None, obj._group)
         return obj
 
+    # (Keep track of which shapes belong to which group)
+    def _regroup(self, obj, old, new):
+        if old is not None and old in self._groups:
+            members = self._groups[old]
+            members.discard(obj)
+            if not members:
+                del self._groups[old]
+        if new is not None:
+            self._groups.setdefault(new, set()).add(obj)
+
     # (Allow iteration over shapes in the window)
     def __iter__(self):
-        return iter(self._shapes[:])
+        return iter(self._shapes.values())
 
     # Get a list of the shapes beneath this point
     def under(self, x, y):
-        ids = self._canvas.find_overlapping(x,y,x,y)
-        return [s for s in self._shapes if s._id in ids]
+        return self._overlapping(x, y, x, y)
 
     # Get a list of the other shapes in contact with this shape
     def touching(self, shape):
-        ids = self._canvas.find_overlapping(shape.left, shape.top, shape.right, shape.bottom)
-        return [s for s in self._shapes if s!=shape and s._id in ids]
+        found = self._overlapping(shape.left, shape.top, shape.right, shape.bottom)
+        return [s for s in found if s is not shape]
+
+    # Get a layer of shapes that can be shown, hidden, moved, removed and restacked together
+    def layer(self, name=None, *extra):
+        command = "window.layer(name)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if name==None:
+            return _sys.missing(command)
+        try:
+            found = self._layers.get(name)
+        except TypeError:
+            return _sys.invalid(command)
+        if found is None:
+            found = layer(self, name, "layer"+str(len(self._layers)))
+            self._layers[name] = found
+        return found
+
+    # Get a list of the shapes in a group
+    def group(self, name):
+        return sorted(self._groups.get(name, ()), key=lambda s : s._order)
+
+    # Get a list of (shapeA, shapeB) pairs in contact between two groups
+    def collisions(self, groupA, groupB):
+        first = self._groups.get(groupA, ())
+        second = self._groups.get(groupB, ())
+        if not first or not second:
+            return []
+        pairs = []
+        for a in first:
+            left, top, right, bottom = a.left, a.top, a.right, a.bottom
+            for b in self._index.query(left, top, right, bottom):
+                if b is a or b not in second:
+                    continue
+                if groupA == groupB and b._order < a._order:
+                    continue
+                if b._hits(left, top, right, bottom):
+                    pairs.append((a,b))
+        pairs.sort(key=lambda (a,b) : (a._order, b._order))
+        return pairs
+
+    # (Get the shapes overlapping a box, in the order they were added)
+    def _overlapping(self, left, top, right, bottom):
+        found = [s for s in self._index.query(left, top, right, bottom)
+                 if s._hits(left, top, right, bottom) and (s._layer is None or not s._layer._hidden)]
+        found.sort(key=lambda s : s._order)
+        return found
 
     # Remove shapes from the window
     def remove(self, shape=None, *otherShapes):
         command = "window.remove(shape, ...)"
         if shape==None:
             return _sys.missing(command)
-        for s in list(otherShapes) + [shape]:
-            if not isinstance(s, _shape):
+        shapes = [shape] + list(otherShapes)
+        for s in shapes:
+            if not isinstance(s, (_shape, particles)):
                 return _sys.invalid(command)
-            if self._closed or s not in self._shapes:
-                return
-            self._shapes.remove(s)
-            s._delete()
+        if self._closed:
+            return
+        found = []
+        for s in shapes:
+            if isinstance(s, particles):
+                if s in self._batches:
+                    self._batches.discard(s)
+                    found.append(s)
+            elif self._shapes.get(s._id) is s:
+                del self._shapes[s._id]
+                found.append(s)
+        if found:
+            self._canvas.delete(*[s._tag if isinstance(s, particles) else s._id for s in found])
+            for s in found:
+                s._forget()
+
+    # Remove every shape from the window
+    def clear(self, *extra):
+        command = "window.clear()"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if not self._closed:
+            self._clear()
+
+    # (Delete every shape with one canvas call and reset the bookkeeping instead of forgetting shapes one by one)
+    def _clear(self):
+        shapes, batches = self._shapes.values(), list(self._batches)
+        if shapes or batches:
+            self._canvas.delete(*[s._id for s in shapes]+[b._tag for b in batches])
+        for s in shapes:
+            s._deleted = True
+            s._layer = None
+        for b in batches:
+            b._deleted = True
+        self._shapes.clear()
+        self._batches.clear()
+        self._index = _grid()
+        self._groups.clear()
+        for found in self._layers.itervalues():
+            found._members.clear()
 
     # Start a timer that ticks periodically
     def startTimer(self, milliseconds=None, function=None, *extra):
@@ -340,60 +2131,441 @@ class window:
             return _sys.error("Handler function "+function.__name__+" should expect no arguments.")
         if self._closed:
             return
-        self._timers.append(function)
-        self._canvas.after(milliseconds, self._runTimer, milliseconds, function)
+        interval = max(milliseconds, 1)
+        entry = [self._now()+interval, self._count, interval, function, True]
+        self._count += 1
+        self._timers.setdefault(function, []).append(entry)
+        heapq.heappush(self._schedule, entry)
+        self._wake()
+
+    # (Get the current time in milliseconds)
+    def _now(self):
+        if self._clock is not None:
+            return self._clock
+        return _sys.backend.now() + self._skew
+
+    # (Make sure a frame is scheduled for the earliest timer deadline)
+    def _wake(self):
+        schedule = self._schedule
+        while schedule and not schedule[0][4]:
+            heapq.heappop(schedule)
+        if self._closed or self._clock is not None:
+            return
+        deadline = schedule[0][0] if schedule else None
+        if self._posted or self._tasks:
+            beat = self._now() + self._heartbeat
+            deadline = beat if deadline is None else min(deadline, beat)
+        if deadline is None:
+            return
+        if self._pending is not None:
+            if self._pendingAt <= deadline:
+                return
+            self._canvas.after_cancel(self._pending)
+        self._pendingAt = deadline
+        delay = int(math.ceil(deadline - self._now()))
+        self._pending = self._canvas.after(max(delay, 0), self._runFrame)
+
+    # (Run posted work, step handler generators, then dispatch every timer that is due, in deadline order; a failing handler still leaves the frame flushed and the next one scheduled)
+    def _runFrame(self):
+        self._pending = None
+        if self._closed:
+            return
+        now = self._now()
+        schedule = self._schedule
+        stats = self._frames
+        budget = None
+        try:
+            if self._posted:
+                self._drain()
+            if self._tasks:
+                tasks, self._tasks = self._tasks, []
+                for task in tasks:
+                    self._resume(task)
+            if schedule and schedule[0][0] <= now:
+                lag = now - schedule[0][0]
+                stats["lag"] = lag
+                stats["totalLag"] += lag
+                stats["maxLag"] = max(stats["maxLag"], lag)
+                stats["frames"] += 1
+            steps = {}
+            while schedule and schedule[0][0] <= now and not self._closed:
+                entry = heapq.heappop(schedule)
+                if not entry[4]:
+                    continue
+                budget = entry[2] if budget is None else min(budget, entry[2])
+                count = steps.get(id(entry), 0)
+                if count >= self._catchup:
+                    stats["dropped"] += int((now - entry[0]) // entry[2]) + 1
+                    entry[0] = now + entry[2]
+                    heapq.heappush(schedule, entry)
+                    continue
+                steps[id(entry)] = count + 1
+                entry[0] += entry[2]
+                heapq.heappush(schedule, entry) # Back in the heap before the handler runs, so an error in it does not end the timer
+                self._runTimer(entry[3])
+        finally:
+            self._flush()
+            work = self._now() - now
+            stats["work"] = work
+            if budget is not None and work > budget:
+                stats["overruns"] += 1
+            self._wake()
+
+    # (Run the work posted before this frame, leaving anything posted meanwhile for the next one)
+    def _drain(self):
+        posted = self._posted
+        for i in xrange(len(posted)):
+            if self._closed:
+                return
+            (function, arguments) = posted.popleft()
+            function(*arguments)
+
+    # (Remember a shape that needs redrawing)
+    def _markDirty(self, shape):
+        self._dirty.add(shape)
+        if not self._flushing and self._clock is None: # simulate() flushes every frame itself, and nothing idles while it runs
+            self._flushing = True
+            self._canvas.after_idle(self._flush)
+
+    # (Send all queued shape changes to the canvas in one call)
+    def _flush(self):
+        self._flushing = False
+        dirty = self._dirty
+        if not dirty:
+            return
+        self._dirty = set()
+        if self._closed:
+            return
+        ops = []
+        for s in dirty:
+            if not s._deleted:
+                s._render(ops)
+        if ops:
+            self._canvas.batch(ops)
 
-    # (Call a function periodically)
-    def _runTimer(self, milliseconds, function):
+    # (Call a timer function)
+    def _runTimer(self, function):
         if self._closed:
             return
-        if function not in self._timers:
+        if self._opened or self._clock is not None:
+            task = function()
+            if task is not None:
+                self._resume(task)
+
+    # (Run a handler's generator up to its next yield, and keep it for the next frame unless it finished; under a running trollius loop, make it a task instead)
+    def _resume(self, task):
+        if not inspect.isgenerator(task) or self._closed:
+            return
+        if _asyncio is not None and _asyncio.get_event_loop().is_running():
+            future = _asyncio.ensure_future(self._drive(task))
+            self._futures.add(future)
+            future.add_done_callback(self._futures.discard)
+            return
+        try:
+            next(task)
+        except StopIteration:
             return
-        if self._opened:
-            function()
-        self._canvas.after(milliseconds, self._runTimer, milliseconds, function)
+        self._tasks.append(task)
+        if self._pending is None:
+            self._wake()
 
-    # Make a running timer stop
-    def stopTimer(self, function=None, *extra):
-        command = "window.stopTimer(function)"
+    # (Coroutine running a handler's generator: a bare yield waits about a frame, and yielding a future or coroutine waits for it and sends back its result or raises its error)
+    def _drive(self, task):
+        (value, failure) = (None, None)
+        while not self._closed:
+            try:
+                step = task.throw(*failure) if failure else task.send(value)
+            except StopIteration:
+                return
+            (value, failure) = (None, None)
+            try:
+                if step is None:
+                    yield _asyncio.From(_asyncio.sleep(self._heartbeat/1000.0))
+                else:
+                    value = yield _asyncio.From(step)
+            except Exception:
+                failure = sys.exc_info()
+        task.close()
+
+    # Run timers for some milliseconds of simulated time without waiting, feeding in scripted input
+    def simulate(self, milliseconds=None, script=[], *extra):
+        command = "window.simulate(milliseconds,script?)"
         if len(extra) > 0:
             return _sys.extra(command)
-        if function==None:
+        if milliseconds==None:
             return _sys.missing(command)
-        if not hasattr(function, "__call__"):
+        try:
+            milliseconds = float(milliseconds)
+            events = [(float(event[0]), n, event[1], tuple(event[2:])) for (n, event) in enumerate(script)]
+        except (ValueError, TypeError, IndexError):
             return _sys.invalid(command)
-        if function in self._timers:
-            self._timers.remove(function)
+        if milliseconds < 0:
+            return _sys.restricted(command)
+        for event in events:
+            if event[2] not in _inputs:
+                return _sys.restricted(command)
+        if self._closed or self._clock is not None:
+            return
+        if self._pending is not None:
+            self._canvas.after_cancel(self._pending)
+            self._pending = None
+        start = self._now()
+        end = start + milliseconds
+        events = [(start+event[0],)+event[1:] for event in events]
+        heapq.heapify(events)
+        schedule = self._schedule
+        self._clock = start
+        try:
+            while not self._closed:
+                while schedule and not schedule[0][4]:
+                    heapq.heappop(schedule)
+                deadline = schedule[0][0] if schedule else end+1
+                if self._posted or self._tasks:
+                    deadline = min(deadline, self._clock + self._heartbeat)
+                if events and events[0][0] <= min(deadline, end):
+                    event = heapq.heappop(events)
+                    self._clock = max(self._clock, event[0])
+                    self._handle(event[2], *event[3])
+                elif deadline <= end:
+                    self._clock = max(self._clock, deadline)
+                    self._runFrame()
+                else:
+                    self._clock = end
+                    break
+        finally:
+            self._skew = self._clock - _sys.backend.now()
+            self._clock = None
+        if self._posted and not self._closed:
+            self._drain()
+        self._flush()
+        self._wake()
 
-    # Assign a function to handle left clicks
-    def onLeftClick(self, function=None, *extra):
-        command = "window.onLeftClick(function)"
+    # Time every handler and redraw, optionally showing the results in the corner of the window
+    def profile(self, enabled=True, hud=False, *extra):
+        command = "window.profile(enabled?,hud?)"
         if len(extra) > 0:
             return _sys.extra(command)
-        if function==None:
-            return _sys.missing(command)
-        if not hasattr(function, "__call__"):
-            return _sys.invalid(command)
-        if inspect.getargspec(function)[0] != ["x","y"]:
-            return _sys.error("Handler function "+function.__name__+" should expect two arguments (x,y).")
         if self._closed:
             return
-        self._frame.bind("<Button-1>", lambda event,function=function:self._mouseHandler(event,function))
+        profile = self._profile
+        if profile is not None:
+            for name in ["_runTimer", "_handle", "_flush"]:
+                del self.__dict__[name]
+            if profile.tcl is not None:
+                self._canvas.tk = profile.tcl.tk
+            if profile.hud is not None:
+                profile.hud[1][4] = False
+                self._canvas.delete(profile.hud[0])
+            self._profile = None
+        if not enabled:
+            return
+        profile = self._profile = _profiler(self._now(), self._frames["frames"])
+        if hasattr(self._canvas, "tk"):
+            profile.tcl = self._canvas.tk = _tclCounter(self._canvas.tk)
+        self.__dict__["_runTimer"] = self._profiledRunTimer
+        self.__dict__["_handle"] = self._profiledHandle
+        self.__dict__["_flush"] = self._profiledFlush
+        if hud:
+            entry = [self._now(), self._count, 500, self._updateHud, True]
+            self._count += 1
+            heapq.heappush(self._schedule, entry)
+            profile.hud = (self._canvas.create_text(4, 4, text="", font=("Courier",10), fill="black", anchor="nw"), entry)
+            self._wake()
+
+    # (Profiled versions of the dispatch methods)
+    def _profiledRunTimer(self, function):
+        if self._closed:
+            return
+        if self._opened or self._clock is not None:
+            self._resume(self._profile.run(function.__name__, function))
+    def _profiledHandle(self, kind, *args):
+        function = self._handlers.get(kind)
+        if function is not None:
+            self._resume(self._profile.run(function.__name__, function, *args))
+            self._flush()
+            self._wake()
+    def _profiledFlush(self):
+        if self._dirty:
+            self._profile.run("(redraw)", window._flush, self)
+        else:
+            self._flushing = False
 
-    # Assign a function to handle left drags
-    def onLeftDrag(self, function=None, *extra):
-        command = "window.onLeftDrag(function)"
+    # (Show the latest profile in the corner)
+    def _updateHud(self):
+        stats = self.stats()
+        lines = ["%.1f of %.1f frames/s, %d Tcl calls" % (stats["fps"], stats["requested"], stats["tcl"])]
+        for (name, handler) in sorted(stats["handlers"].iteritems()):
+            lines.append("%-16s %6.2f ms %6.2f max" % (name[:16], handler["mean"], handler["max"]))
+        self._canvas.itemconfig(self._profile.hud[0], text="\n".join(lines))
+
+    # Get profiling statistics: frame timing, plus calls, time and rate for each handler while profiling
+    def stats(self):
+        stats = {"frames":self.frameStats()}
+        profile = self._profile
+        if profile is None:
+            return stats
+        seconds = max(self._now() - profile.start, 1.0)/1000
+        requested = {}
+        for (function, entries) in self._timers.iteritems():
+            requested[function.__name__] = requested.get(function.__name__, 0) + sum([1000.0/e[2] for e in entries])
+        handlers = {}
+        for (name, (calls, total, longest, tcl, recent)) in profile.handlers.iteritems():
+            handlers[name] = {"calls":calls, "time":total, "mean":total/max(calls, 1), "max":longest, "tcl":tcl, "rate":calls/seconds}
+            if name in requested:
+                handlers[name]["requested"] = requested[name]
+        stats["handlers"] = handlers
+        stats["fps"] = (self._frames["frames"] - profile.frames)/seconds
+        stats["requested"] = max(requested.values() or [0])
+        stats["tcl"] = profile.tcl.calls if profile.tcl is not None else 0
+        return stats
+
+    # Get the timing statistics of recent frames
+    def frameStats(self):
+        stats = dict(self._frames)
+        stats["meanLag"] = stats.pop("totalLag") / max(stats["frames"], 1)
+        return stats
+
+    # Get what the window shows as a bytearray of r,g,b values, row by row
+    def pixels(self, *extra):
+        command = "window.pixels()"
         if len(extra) > 0:
             return _sys.extra(command)
-        if function==None:
-            return _sys.missing(command)
-        if not hasattr(function, "__call__"):
-            return _sys.invalid(command)
-        if inspect.getargspec(function)[0] != ["x","y"]:
-            return _sys.error("Handler function "+function.__name__+" should expect two arguments (x,y).")
         if self._closed:
             return
-        self._frame.bind("<B1-Motion>", lambda event,function=function:self._mouseHandler(event,function))
+        self._flush()
+        return self._canvas.render()
+
+    # Start saving frames to an animated .gif, numbered .png files, or a raw r,g,b stream ("-" for stdout); while showing, frames the writer can't keep up with repeat the one before
+    def record(self, path=None, fps=30, frames=None, *extra):
+        command = "window.record(path,fps?,frames?)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if path==None:
+            return _sys.missing(command)
+        try:
+            path = str(path)
+            fps = float(fps)
+            if frames is not None:
+                frames = int(frames)
+        except ValueError:
+            return _sys.invalid(command)
+        if fps <= 0 or fps > 100 or (frames is not None and frames < 1):
+            return _sys.restricted(command)
+        if self._closed:
+            return
+        self.stopRecording()
+        if path.lower().endswith(".gif"):
+            kind = _gifRecorder
+        elif path.lower().endswith(".png"):
+            kind = _pngRecorder
+        else:
+            kind = _rawRecorder
+        recorder = kind(path, self.width+1, self.height+1, fps, frames)
+        recorder.start()
+        interval = 1000.0/fps
+        entry = [self._now(), self._count, interval, self._capture, True]
+        self._count += 1
+        heapq.heappush(self._schedule, entry)
+        self._recording = (recorder, entry)
+        self._wake()
+
+    # Stop saving frames and finish the file
+    def stopRecording(self):
+        if self._recording is None:
+            return
+        (recorder, entry) = self._recording
+        entry[4] = False
+        self._recording = None
+        recorder.queue.put((None, recorder.skipped))
+        recorder.join()
+        if recorder.failure is not None:
+            return _sys.error("Recording to "+recorder.path+" failed: "+str(recorder.failure))
+
+    # (Hand a copy of the canvas to the recorder, which draws and writes it on its own thread)
+    def _capture(self):
+        (recorder, entry) = self._recording
+        if self._clock is None and recorder.queue.full():
+            # Rather than wait for the writer in real time, skip this frame; simulate() waits so its recordings stay whole
+            recorder.skipped += 1
+            recorder.dropped += 1
+            self._frames["unrecorded"] += 1
+        else:
+            self._flush()
+            canvas = self._canvas.snapshot()
+            if (canvas.width, canvas.height) != (recorder.columns, recorder.rows):
+                return self.stopRecording()
+            recorder.queue.put((canvas, recorder.skipped))
+            recorder.skipped = 0
+            recorder.captured += 1
+        if recorder.captured + recorder.dropped == recorder.frames:
+            self.stopRecording()
+
+    # Make a running timer stop
+    def stopTimer(self, function=None, *extra):
+        command = "window.stopTimer(function)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if function==None:
+            return _sys.missing(command)
+        if not hasattr(function, "__call__"):
+            return _sys.invalid(command)
+        entries = self._timers.get(function)
+        if entries:
+            entries.pop(0)[4] = False
+            if not entries:
+                del self._timers[function]
+
+    # Run a function with some arguments on the window's own thread at its next frame; safe to call from any thread
+    def post(self, function=None, *arguments):
+        command = "window.post(function,arguments...)"
+        if function==None:
+            return _sys.missing(command)
+        if not hasattr(function, "__call__"):
+            return _sys.invalid(command)
+        if self._closed:
+            return
+        self._posted.append((function, arguments))
+        if threading.current_thread() is self._thread:
+            self._wake()
+        elif not self._waking:
+            self._waking = True
+            if not _sys.backend.wake(self._frame, self._wakeUp):
+                self._waking = False # Nothing is waiting to be woken; open() or the next pump() finds the posted work
+
+    # (Schedule a frame for work posted from another thread, back on the window's own thread)
+    def _wakeUp(self):
+        self._waking = False
+        self._wake()
+
+    # Assign a function to handle left clicks
+    def onLeftClick(self, function=None, *extra):
+        command = "window.onLeftClick(function)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if function==None:
+            return _sys.missing(command)
+        if not hasattr(function, "__call__"):
+            return _sys.invalid(command)
+        if inspect.getargspec(function)[0] != ["x","y"]:
+            return _sys.error("Handler function "+function.__name__+" should expect two arguments (x,y).")
+        if self._closed:
+            return
+        self._bind("leftClick", function)
+
+    # Assign a function to handle left drags
+    def onLeftDrag(self, function=None, *extra):
+        command = "window.onLeftDrag(function)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if function==None:
+            return _sys.missing(command)
+        if not hasattr(function, "__call__"):
+            return _sys.invalid(command)
+        if inspect.getargspec(function)[0] != ["x","y"]:
+            return _sys.error("Handler function "+function.__name__+" should expect two arguments (x,y).")
+        if self._closed:
+            return
+        self._bind("leftDrag", function)
 
     # Assign a function to handle right clicks
     def onRightClick(self, function=None, *extra):
@@ -408,7 +2580,7 @@ class window:
             return _sys.error("Handler function "+function.__name__+" should expect two arguments (x,y).")
         if self._closed:
             return
-        self._frame.bind("<Button-3>", lambda event,function=function:self._mouseHandler(event,function))
+        self._bind("rightClick", function)
 
     # Assign a function to handle right drags
     def onRightDrag(self, function=None, *extra):
@@ -423,7 +2595,7 @@ class window:
             return _sys.error("Handler function "+function.__name__+" should expect two arguments (x,y).")
         if self._closed:
             return
-        self._frame.bind("<B3-Motion>", lambda event,function=function:self._mouseHandler(event,function))
+        self._bind("rightDrag", function)
 
     # Assign a function to handle key presses
     def onKey(self, function=None, *extra):
@@ -438,15 +2610,28 @@ class window:
             return _sys.error("Handler function "+function.__name__+" should expect one argument (key).")
         if self._closed:
             return
-        self._frame.bind("<KeyPress>", lambda event,function=function:self._keyHandler(event,function))
+        self._bind("key", function)
 
-    # (Give mouse handlers simple arguments)
-    def _mouseHandler(self, event, function):
-        function(event.x, event.y)
+    # (Register a handler and listen for its input)
+    def _bind(self, kind, function):
+        if kind not in self._handlers:
+            (sequence, arguments) = _inputs[kind]
+            self._frame.bind(sequence, lambda event : self._handle(kind, *arguments(event)))
+        self._handlers[kind] = function
 
-    # (Give key handlers simple arguments)
-    def _keyHandler(self, event, function):
-        function(event.keysym)
+    # (Give an input handler simple arguments)
+    def _handle(self, kind, *args):
+        function = self._handlers.get(kind)
+        if function is not None:
+            self._resume(function(*args))
+            self._flush()
+            self._wake()
+
+    # (Run a button handler like other input handlers)
+    def _press(self, function, *args):
+        self._resume(function(*args))
+        self._flush()
+        self._wake()
 
     # Make the window visible
     def open(self, title="intrographics", *extra):
@@ -457,12 +2642,60 @@ class window:
             title = str(title)
         except ValueError:
             return _sys.invalid(command)
+        if self._show(title):
+            _sys.showFrame(self)
+
+    # Make the window visible and keep it running from a trollius event loop, pumping it some times a second
+    def runAsync(self, fps=60, title="intrographics", *extra):
+        command = "window.runAsync(fps?,title?)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        try:
+            fps = float(fps)
+            title = str(title)
+        except ValueError:
+            return _sys.invalid(command)
+        if fps <= 0 or fps > 1000:
+            return _sys.restricted(command)
+        if _asyncio is None:
+            return _sys.error("window.runAsync() needs the trollius package.")
+        return self._runAsync(1.0/fps, title)
+
+    # (Coroutine that shows the window and pumps it until it closes or runs out of time)
+    def _runAsync(self, seconds, title):
+        if self._show(title):
+            _sys.showFrame(self, False)
+            while self.pump():
+                yield _asyncio.From(_asyncio.sleep(seconds))
+
+    # Handle waiting input and run due timers without blocking, for a window driven by another loop; say whether it is still open
+    def pump(self, *extra):
+        command = "window.pump()"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if not self._opened and self._show("intrographics"):
+            _sys.showFrame(self, False)
+        if self._closed:
+            return False
+        if self._posted:
+            self._drain()
+            self._flush()
+            self._wake()
+        return not self._closed and _sys.backend.pump(self._frame) and not self._closed
+
+    # (Get the window ready to show, or simulate it instead when asked to; say whether it still needs showing)
+    def _show(self, title):
         if self._opened or self._closed:
-            return
+            return False
         self._frame.wm_title(title)
         self._canvas.pack()
         self._opened = True
-        _sys.showFrame(self)
+        if _sys.simulation is not None:
+            self.simulate(*_sys.simulation)
+            self._finish()
+            return False
+        self._wake()
+        return True
 
     # Close the window
     def close(self, output="", *extra):
@@ -473,53 +2706,367 @@ class window:
             output = str(output)
         except ValueError:
             return _sys.invalid(command)
-        if not self._opened or self._closed:
+        if self._closed or not (self._opened or self._clock is not None):
+            return
+        self._finish()
+        print output
+
+    # (Remove everything, finish recording and profiling, and destroy the frame)
+    def _finish(self):
+        if self._closed:
             return
-        for obj in self._shapes:
-            self.remove(obj)
+        self._clear()
+        self._posted.clear()
+        for task in self._tasks:
+            task.close()
+        del self._tasks[:]
+        for future in list(self._futures):
+            future.cancel()
+        self.stopRecording()
+        if self._profile is not None:
+            self._profile.dump(self.stats(), sys.stderr)
         self._closed = True
         _sys.destroyFrame(self)
-        print output
+
+# (Timing and Tcl call counts collected while a window is profiled)
+class _profiler:
+    history = 256 # Recent durations kept for each handler's histogram
+    buckets = [0.5, 1, 2, 4, 8, 16, 32] # Histogram bucket limits in milliseconds
+
+    def __init__(self, start, frames):
+        self.start = start # Window time when profiling began
+        self.frames = frames # Frame count when profiling began
+        self.handlers = {} # Name -> [calls, total ms, max ms, Tcl calls, recent durations]
+        self.tcl = None # Counting proxy for the canvas' Tcl interpreter
+        self.hud = None # (canvas text id, schedule entry) while showing the overlay
+
+    # (Call a function, recording its wall time and the Tcl calls it makes)
+    def run(self, name, function, *args):
+        handler = self.handlers.get(name)
+        if handler is None:
+            handler = self.handlers[name] = [0, 0.0, 0.0, 0, deque(maxlen=self.history)]
+        tcl = self.tcl.calls if self.tcl is not None else 0
+        start = time.time()
+        try:
+            return function(*args)
+        finally:
+            elapsed = (time.time() - start)*1000
+            handler[0] += 1
+            handler[1] += elapsed
+            handler[2] = max(handler[2], elapsed)
+            if self.tcl is not None:
+                handler[3] += self.tcl.calls - tcl
+            handler[4].append(elapsed)
+
+    # (Print a summary and a histogram of recent durations for each handler)
+    def dump(self, stats, output):
+        print >>output, "Profile: %d frames, %.1f of %.1f frames/s, %d Tcl calls" % (stats["frames"]["frames"] - self.frames, stats["fps"], stats["requested"], stats["tcl"])
+        for (name, handler) in sorted(stats["handlers"].iteritems()):
+            print >>output, "  %s: %d calls, %.1f/s, mean %.2f ms, max %.2f ms, %d Tcl calls" % (name, handler["calls"], handler["rate"], handler["mean"], handler["max"], handler["tcl"])
+            recent = self.handlers[name][4]
+            counts = [0]*(len(self.buckets)+1)
+            for elapsed in recent:
+                counts[len([b for b in self.buckets if b <= elapsed])] += 1
+            labels = ["<"+str(self.buckets[0])]+[str(b)+"+" for b in self.buckets]
+            for (label, count) in zip(labels, counts):
+                if count:
+                    print >>output, "    %6s ms %-40s %d" % (label, "#"*int(math.ceil(40.0*count/len(recent))), count)
+
+# (Wraps a Tcl interpreter to count the calls made through it)
+class _tclCounter:
+    def __init__(self, tk):
+        self.tk = tk
+        self.calls = 0
+    def call(self, *args):
+        self.calls += 1
+        return self.tk.call(*args)
+    def eval(self, script):
+        self.calls += 1
+        return self.tk.eval(script)
+    def __getattr__(self, name):
+        return getattr(self.tk, name)
+
+# (Input kinds that can be handled or simulated, with their Tk event and handler arguments)
+_inputs = {
+    "leftClick": ("<Button-1>", lambda event : (event.x, event.y)),
+    "leftDrag": ("<B1-Motion>", lambda event : (event.x, event.y)),
+    "rightClick": ("<Button-3>", lambda event : (event.x, event.y)),
+    "rightDrag": ("<B3-Motion>", lambda event : (event.x, event.y)),
+    "key": ("<KeyPress>", lambda event : (event.keysym,)),
+}
+
+# (A read-only shape attribute computed on demand)
+def _readOnly(attribute, get):
+    def refuse(self, value):
+        return _sys.immutable(attribute, self.__class__.__name__)
+    return property(get, refuse)
+
+# A color that can be used anywhere a color name or (r,g,b) is expected
+class color(object):
+    __slots__ = ["_value", "_hex"]
+
+    def __init__(self, value=None, *extra):
+        command = "intrographics.color(value)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if value==None:
+            return _sys.missing(command)
+        if isinstance(value, color):
+            value = value._value
+        if not isinstance(value, (basestring, tuple)):
+            return _sys.invalid(command)
+        if type(value) == tuple and not _sys.isRGB(value):
+            return _sys.restricted(command)
+        self._value = value
+        self._hex = None
+
+    # (Resolve the color the first time it is needed)
+    def _getHex(self):
+        if self._hex is None:
+            self._hex = _sys.toHex(self._value)
+        return self._hex
+    hex = _readOnly("hex", _getHex)
+    red = _readOnly("red", lambda self : int(self._getHex()[1:3], 16))
+    green = _readOnly("green", lambda self : int(self._getHex()[3:5], 16))
+    blue = _readOnly("blue", lambda self : int(self._getHex()[5:7], 16))
+
+    def __eq__(self, other):
+        return isinstance(other, color) and self.hex == other.hex
+    def __ne__(self, other):
+        return not self == other
+    def __hash__(self):
+        return hash(self.hex)
+    def __repr__(self):
+        return "color("+repr(self._value)+")"
+
+# A named set of shapes in a window, shown, hidden, moved, removed and restacked with one canvas operation each
+class layer(object):
+    __slots__ = ["_window", "_name", "_tag", "_members", "_hidden"]
+
+    def __init__(self, window, name, tag):
+        self._window = window
+        self._name = name
+        self._tag = tag # Canvas tag on the item of every member
+        self._members = set()
+        self._hidden = False
+
+    # (Read-only name and visibility)
+    name = _readOnly("name", lambda self : self._name)
+    hidden = _readOnly("hidden", lambda self : self._hidden)
+
+    # (Allow iteration over the shapes in the layer, in the order they were added)
+    def __iter__(self):
+        return iter(sorted(self._members, key=lambda s : s._order))
+    def __len__(self):
+        return len(self._members)
+
+    # Put shapes in this layer, above the shapes already in it; they leave any other layer
+    def add(self, shape=None, *otherShapes):
+        command = "layer.add(shape, ...)"
+        if shape==None:
+            return _sys.missing(command)
+        shapes = [shape] + list(otherShapes)
+        for s in shapes:
+            if not isinstance(s, _shape) or s._window is not self._window:
+                return _sys.invalid(command)
+        if self._window._closed:
+            return
+        canvas = self._window._canvas
+        for s in shapes:
+            old = s._layer
+            if s._deleted or old is self:
+                continue
+            if old is not None:
+                canvas.dtag(s._id, old._tag)
+                old._members.discard(s)
+            if self._members:
+                canvas.tag_raise(s._id, self._tag)
+            canvas.addtag_withtag(self._tag, s._id)
+            if self._hidden or (old is not None and old._hidden):
+                canvas.itemconfig(s._id, state="hidden" if self._hidden else "normal")
+            s._layer = self
+            self._members.add(s)
+
+    # Show the shapes in this layer
+    def show(self, *extra):
+        command = "layer.show()"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if self._window._closed:
+            return
+        self._hidden = False
+        self._window._canvas.itemconfig(self._tag, state="normal")
+
+    # Hide the shapes in this layer
+    def hide(self, *extra):
+        command = "layer.hide()"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if self._window._closed:
+            return
+        self._hidden = True
+        self._window._canvas.itemconfig(self._tag, state="hidden")
+
+    # Move every shape in this layer
+    def move(self, dx=None, dy=None, *extra):
+        command = "layer.move(dx,dy)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if dx==None or dy==None:
+            return _sys.missing(command)
+        try:
+            dx, dy = int(dx), int(dy)
+        except ValueError:
+            return _sys.invalid(command)
+        if self._window._closed:
+            return
+        self._window._canvas.move(self._tag, dx, dy)
+        for s in self._members:
+            s._shift(dx, dy)
+
+    # Remove every shape in this layer from the window
+    def remove(self, *extra):
+        command = "layer.remove()"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        window = self._window
+        if window._closed:
+            return
+        window._canvas.delete(self._tag)
+        for s in list(self._members):
+            del window._shapes[s._id]
+            s._forget()
+
+    # Stack this layer above every other shape
+    def lift(self, *extra):
+        command = "layer.lift()"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if not self._window._closed:
+            self._window._canvas.tag_raise(self._tag)
+
+    # Stack this layer below every other shape
+    def lower(self, *extra):
+        command = "layer.lower()"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if not self._window._closed:
+            self._window._canvas.tag_lower(self._tag)
+
+    def __repr__(self):
+        return "layer("+repr(self._name)+")"
 
 # (Any shape displayed in a window)
 class _shape(object):
+    # Geometry lives in slots; __dict__ only appears once a user attribute is set
+    __slots__ = ["_canvas", "_deleted", "_window", "_stale", "_config", "_id", "_order", "_group", "_layer", "__dict__"]
+
     def __init__(self, canvas):
         self._canvas = canvas
         self._deleted = False
+        self._window = None
+        self._layer = None
+        self._stale = False # Coordinates changed since the last flush
+        self._config = None # Item options changed since the last flush
 
-    # (Disallow direct changes to some attributes)
-    def __setattr__(self, attribute, value):
-        if attribute in ["left", "top", "right", "bottom"]:
-            return _sys.immutable(attribute, self.__class__.__name__)
-        super(_shape,self).__setattr__(attribute, value)
+    # (Allow shapes to be sorted into groups)
+    def _getGroup(self):
+        try:
+            return self._group
+        except AttributeError:
+            raise AttributeError("'"+self.__class__.__name__+"' object has no attribute 'group'")
+    def _setGroup(self, value):
+        if self._window is not None and not self._deleted:
+            self._window._regroup(self, getattr(self, "_group", None), value)
+        self._group = value
+    group = property(_getGroup, _setGroup)
+
+    # (Check whether this shape overlaps a box)
+    def _hits(self, left, top, right, bottom):
+        return self.left <= right and left <= self.right and self.top <= bottom and top <= self.bottom
+
+    # (Read-only edges, for shapes that store them directly)
+    left = _readOnly("left", lambda self : self._left)
+    top = _readOnly("top", lambda self : self._top)
+    right = _readOnly("right", lambda self : self._right)
+    bottom = _readOnly("bottom", lambda self : self._bottom)
+
+    # (Keep the window's collision index current)
+    def _reindex(self):
+        if self._window is not None:
+            self._window._index.update(self)
+
+    # (Reindex and queue new coordinates for the next flush)
+    def _moved(self):
+        window = self._window
+        if window is None:
+            self._canvas.coords(self._id, *self._coords())
+            return
+        window._index.update(self)
+        self._stale = True
+        window._markDirty(self)
+
+    # (Add the canvas operations that bring this shape up to date)
+    def _render(self, ops):
+        if self._stale:
+            self._stale = False
+            ops.append(("coords", self._id, self._coords()))
+        if self._config is not None:
+            ops.append(("config", self._id, self._config))
+            self._config = None
+
+    # (Queue new item options for the next flush)
+    def _restyle(self, **options):
+        window = self._window
+        if window is None:
+            self._canvas.itemconfig(self._id, **options)
+            return
+        if self._config is None:
+            self._config = options
+        else:
+            self._config.update(options)
+        window._markDirty(self)
 
-    # (Take this shape off the canvas)
-    def _delete(self):
+    # (Drop this shape from the window's index, groups and layers once its item is gone)
+    def _forget(self):
         self._deleted = True
-        self._canvas.delete(self._id)
+        if self._layer is not None:
+            self._layer._members.discard(self)
+            self._layer = None
+        if self._window is not None:
+            self._window._index.remove(self)
+            self._window._regroup(self, getattr(self, "_group", None), None)
 
 # (A shape specified by a bounding box)
 class _boxShape(_shape):
+    __slots__ = ["_x", "_y", "_width", "_height"]
+
     def __init__(self, canvas, x, y, width, height):
         super(_boxShape,self).__init__(canvas)
         self._configure(x, y, width, height)
 
-    # (Disallow direct changes to some attributes)
-    def __setattr__(self, attribute, value):
-        if attribute in ["width", "height"]:
-            return _sys.immutable(attribute, self.__class__.__name__)
-        super(_boxShape,self).__setattr__(attribute, value)   
+    # (Read-only edges and size)
+    left = _readOnly("left", lambda self : self._x)
+    top = _readOnly("top", lambda self : self._y)
+    right = _readOnly("right", lambda self : self._x+self._width)
+    bottom = _readOnly("bottom", lambda self : self._y+self._height)
+    width = _readOnly("width", lambda self : self._width)
+    height = _readOnly("height", lambda self : self._height)
 
     # (Update the shape location and/or size)
     def _configure(self, x, y, width, height):
-        self._canvas.coords(self._id, (x, y, x+width, y+height))
         self._x, self._y, self._width, self._height = x, y, width, height
-        self.__dict__["width"] = width
-        self.__dict__["height"] = height
-        self.__dict__["left"] = x
-        self.__dict__["top"] = y
-        self.__dict__["right"] = x+width
-        self.__dict__["bottom"] = y+height
+        self._moved()
+
+    # (Get the coordinates Tk should draw at)
+    def _coords(self):
+        return (self._x, self._y, self._x+self._width, self._y+self._height)
+
+    # (Follow a move the canvas already made)
+    def _shift(self, dx, dy):
+        self._x += dx
+        self._y += dy
+        self._reindex()
 
     # Change the color scheme of this shape
     def paint(self, color=None, borderWidth=1, borderColor="black", *extra):
@@ -534,7 +3081,7 @@ class _boxShape(_shape):
             return _sys.invalid(command)
         if self._deleted:
             return
-        self._canvas.itemconfig(self._id, fill=_sys.toHex(color), width=borderWidth, outline=_sys.toHex(borderColor))
+        self._restyle(fill=_sys.toHex(color), width=borderWidth, outline=_sys.toHex(borderColor))
 
     # Move this shape
     def move(self, dx=None, dy=None, *extra):
@@ -585,30 +3132,139 @@ class _boxShape(_shape):
 
 # A rectangle shape
 class rectangle(_boxShape):
+    __slots__ = []
+
     def __init__(self, canvas, x, y, width, height):
         self._id = canvas.create_rectangle(0,0,0,0, width=1)
         super(rectangle,self).__init__(canvas, x, y, width, height)
 
 # An oval shape
 class oval(_boxShape):
+    __slots__ = []
+
     def __init__(self, canvas, x, y, width, height):
         self._id = canvas.create_oval(0,0,0,0, width=1)
         super(oval,self).__init__(canvas, x, y, width, height)
 
+    # (Check whether the curve itself reaches into a box)
+    def _hits(self, left, top, right, bottom):
+        if not super(oval,self)._hits(left, top, right, bottom):
+            return False
+        rx, ry = self._width/2.0 + 0.5, self._height/2.0 + 0.5
+        cx, cy = self._x + self._width/2.0, self._y + self._height/2.0
+        px, py = min(max(cx, left), right), min(max(cy, top), bottom)
+        return ((px-cx)/rx)**2 + ((py-cy)/ry)**2 <= 1
+
 # (A shape specified by a list of points)
 class _listShape(_shape):
+    __slots__ = ["_points", "_dx", "_dy", "_shiftX", "_shiftY", "_sent", "_left", "_top", "_right", "_bottom", "_thickness"]
+
     def __init__(self, canvas, points):
         super(_listShape,self).__init__(canvas)
-        self._configure(points)
+        self._thickness = 1 # Drawn width of the line or outline, for hit tests
+        self._configure(array("i", [c for p in points for c in p]))
 
-    # (Update the shape location)
+    # (Update the shape location from a flat array of x,y values)
     def _configure(self, points):
-        self._canvas.coords(self._id, tuple([c for p in points for c in p]))
         self._points = points
-        self.__dict__["left"] = min(x for (x,y) in points)
-        self.__dict__["top"] = min(y for (x,y) in points)
-        self.__dict__["right"] = max(x for (x,y) in points)
-        self.__dict__["bottom"] = max(y for (x,y) in points)
+        self._dx = self._dy = 0 # Offset of the real points from the stored ones
+        self._shiftX = self._shiftY = 0 # Movement the canvas hasn't seen yet
+        self._sent = len(points) # Values the canvas already has
+        xs, ys = points[0::2], points[1::2]
+        self._left, self._top, self._right, self._bottom = min(xs), min(ys), max(xs), max(ys)
+        self._moved()
+
+    # (Move every point without touching them, by keeping an offset)
+    def _translate(self, dx, dy):
+        self._dx += dx
+        self._dy += dy
+        self._left += dx
+        self._right += dx
+        self._top += dy
+        self._bottom += dy
+        window = self._window
+        if window is None:
+            self._canvas.move(self._id, dx, dy)
+            return
+        self._shiftX += dx
+        self._shiftY += dy
+        window._index.update(self)
+        window._markDirty(self)
+
+    # (Follow a move the canvas already made)
+    def _shift(self, dx, dy):
+        self._dx += dx
+        self._dy += dy
+        self._left += dx
+        self._right += dx
+        self._top += dy
+        self._bottom += dy
+        self._reindex()
+
+    # (Get the coordinates Tk should draw at, folding in the offset)
+    def _coords(self):
+        if self._dx or self._dy:
+            self._points = array("i", map(add, self._points, array("i", [self._dx, self._dy])*(len(self._points)//2)))
+            self._dx = self._dy = 0
+        return self._points
+
+    # (Add the canvas operations that bring this shape up to date: a move and new points if that's enough)
+    def _render(self, ops):
+        if not self._stale:
+            if self._shiftX or self._shiftY:
+                ops.append(("move", self._id, self._shiftX, self._shiftY))
+            if self._sent < len(self._points):
+                added = self._points[self._sent:]
+                if self._dx or self._dy:
+                    added = array("i", map(add, added, array("i", [self._dx, self._dy])*(len(added)//2)))
+                ops.append(("insert", self._id, added))
+        self._shiftX = self._shiftY = 0
+        self._sent = len(self._points)
+        super(_listShape,self)._render(ops)
+
+    # (Remember the drawn width for hit tests, then queue new item options)
+    def _restyle(self, **options):
+        if "width" in options:
+            self._thickness = options["width"]
+        super(_listShape,self)._restyle(**options)
+
+    # (Check whether any edge, widened to the drawn width, reaches into a box; closed shapes also join the last point to the first)
+    def _edgesHit(self, left, top, right, bottom, closed):
+        reach = self._thickness/2.0
+        (left, top, right, bottom) = (left-self._dx, top-self._dy, right-self._dx, bottom-self._dy)
+        points = self._points
+        (x1, y1) = (points[-2], points[-1]) if closed else (points[0], points[1])
+        for i in xrange(0, len(points), 2):
+            (x2, y2) = (points[i], points[i+1])
+            if _segmentNearBox(x1, y1, x2, y2, left, top, right, bottom, reach):
+                return True
+            (x1, y1) = (x2, y2)
+        return False
+
+    # Add a point to the end of this shape
+    def appendPoint(self, x=None, y=None, *extra):
+        command = self.__class__.__name__+".appendPoint(x,y)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if x==None or y==None:
+            return _sys.missing(command)
+        try:
+            x, y = int(x), int(y)
+        except ValueError:
+            return _sys.invalid(command)
+        if self._deleted:
+            return
+        self._points.append(x-self._dx)
+        self._points.append(y-self._dy)
+        self._left, self._right = min(self._left, x), max(self._right, x)
+        self._top, self._bottom = min(self._top, y), max(self._bottom, y)
+        window = self._window
+        if window is None:
+            self._canvas.coords(self._id, *self._coords())
+            self._sent = len(self._points)
+            return
+        window._index.update(self)
+        window._markDirty(self)
 
     # Move this shape
     def move(self, dx=None, dy=None, *extra):
@@ -623,14 +3279,33 @@ class _listShape(_shape):
             return _sys.invalid(command)
         if self._deleted:
             return
-        self._configure(tuple(map(lambda p : (p[0]+dx,p[1]+dy) , self._points)))
+        self._translate(dx, dy)
 
 # A polygon shape
 class polygon(_listShape):
+    __slots__ = []
+
     def __init__(self, canvas, points):
         self._id = canvas.create_polygon(0,0,0,0,0,0, width=1)
         super(polygon,self).__init__(canvas, points)
 
+    # (Check whether the outline or the inside of the polygon reaches into a box)
+    def _hits(self, left, top, right, bottom):
+        if not super(polygon,self)._hits(left, top, right, bottom):
+            return False
+        if self._edgesHit(left, top, right, bottom, True):
+            return True
+        (x, y) = (left-self._dx, top-self._dy) # No edge crosses the box, so it is inside if any corner is
+        points = self._points
+        inside = False
+        (x1, y1) = (points[-2], points[-1])
+        for i in xrange(0, len(points), 2):
+            (x2, y2) = (points[i], points[i+1])
+            if (y1 > y) != (y2 > y) and x < x1 + (y-y1)*float(x2-x1)/(y2-y1):
+                inside = not inside
+            (x1, y1) = (x2, y2)
+        return inside
+
     # Change the color scheme of this polygon
     def paint(self, color=None, borderWidth=1, borderColor="black", *extra):
         command = "polygon.paint(color,borderWidth?,borderColor?)"
@@ -645,16 +3320,24 @@ class polygon(_listShape):
         if self._deleted:
             return
 	if borderWidth == 0:
-            self._canvas.itemconfig(self._id, fill=_sys.toHex(color), width=borderWidth)
+            self._restyle(fill=_sys.toHex(color), width=borderWidth)
         else:
-            self._canvas.itemconfig(self._id, fill=_sys.toHex(color), width=borderWidth, outline=_sys.toHex(borderColor))
+            self._restyle(fill=_sys.toHex(color), width=borderWidth, outline=_sys.toHex(borderColor))
 
 # A line shape
 class line(_listShape):
+    __slots__ = []
+
     def __init__(self, canvas, points):
         self._id = canvas.create_line(0,0,0,0, width=1)
         super(line,self).__init__(canvas, points)
 
+    # (Check whether a segment of the line, at its drawn width, reaches into a box)
+    def _hits(self, left, top, right, bottom):
+        if not super(line,self)._hits(left, top, right, bottom):
+            return False
+        return self._edgesHit(left, top, right, bottom, False)
+
     # Change the color scheme of this line
     def paint(self, color=None, width=1, *extra):
         command = "line.paint(color,width?)"
@@ -670,22 +3353,199 @@ class line(_listShape):
             return _sys.restricted(command)
         if self._deleted:
             return
-        self._canvas.itemconfig(self._id, fill=_sys.toHex(color), width=width)
+        self._restyle(fill=_sys.toHex(color), width=width)
+
+# A plot of the latest values in a stream, drawn as one line with a min/max stroke per pixel column
+class plot(_boxShape):
+    __slots__ = ["_values", "_next", "_total", "_span", "_mins", "_maxs", "_low", "_high"]
+
+    def __init__(self, canvas, x, y, width, height, capacity):
+        self._id = canvas.create_line(0,0,0,0, width=1)
+        self._values = array("d", [0.0]) * capacity # Ring buffer of the latest values
+        self._next = 0 # Where the next value goes in the ring
+        self._total = 0 # Values pushed so far
+        self._low = self._high = None # Fixed vertical range, or None to fit the values
+        self._mins = self._maxs = None
+        super(plot,self).__init__(canvas, x, y, width, height)
+
+    capacity = _readOnly("capacity", lambda self : len(self._values))
+
+    # (Update the location and/or size, regrouping the values into columns if the width changed)
+    def _configure(self, x, y, width, height):
+        span = -(-len(self._values) // width) # Values per column
+        columns = -(-len(self._values) // span) # Just enough columns for the capacity, and never more than the width
+        if self._mins is None or (span, columns) != (self._span, len(self._mins)):
+            self._span = span
+            self._mins = array("d", [0.0]) * columns
+            self._maxs = array("d", [0.0]) * columns
+            values = self.values()
+            self._total = self._next = 0
+            for value in values:
+                self._push(value)
+        super(plot,self)._configure(x, y, width, height)
+
+    # (Store a value, updating the min and max of its column)
+    def _push(self, value):
+        values = self._values
+        values[self._next] = value
+        self._next = (self._next+1) % len(values)
+        n = self._total
+        self._total = n+1
+        column = (n // self._span) % len(self._mins)
+        if n % self._span == 0:
+            self._mins[column] = self._maxs[column] = value
+        elif value < self._mins[column]:
+            self._mins[column] = value
+        elif value > self._maxs[column]:
+            self._maxs[column] = value
+
+    # (Redraw at the next flush)
+    def _changed(self):
+        window = self._window
+        if window is None:
+            self._canvas.coords(self._id, *self._coords())
+            return
+        self._stale = True
+        window._markDirty(self)
+
+    # (Get the line Tk should draw: newest column on the right)
+    def _coords(self):
+        columns = len(self._mins)
+        count = min(columns, -(-self._total // self._span))
+        if count == 0:
+            return (self._x, self._y+self._height, self._x+self._width, self._y+self._height)
+        last = (self._total-1) // self._span
+        order = [(last-count+1+k) % columns for k in xrange(count)]
+        mins = [self._mins[c] for c in order]
+        maxs = [self._maxs[c] for c in order]
+        first = (last-count+1) * self._span # Oldest value in the oldest column
+        held = self._total - len(self._values) # Oldest value still in the ring
+        if first < held: # The ring has dropped some of that column, so measure what is left of it
+            values = self._values
+            kept = [values[n % len(values)] for n in xrange(held, min(first+self._span, self._total))]
+            mins[0], maxs[0] = min(kept), max(kept)
+        low = min(mins) if self._low is None else self._low
+        high = max(maxs) if self._high is None else self._high
+        scale = self._height / float(high-low) if high > low else 0.0
+        bottom = self._y+self._height
+        left = self._x+self._width-count
+        points = array("i")
+        for k in xrange(count):
+            top = int(round(bottom - (min(max(maxs[k], low), high)-low)*scale))
+            points.extend([left+k, top, left+k, max(top, int(round(bottom - (min(max(mins[k], low), high)-low)*scale)))])
+        return points
+
+    # Add a value to the plot, forgetting the oldest once it's full
+    def push(self, value=None, *extra):
+        command = "plot.push(value)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if value==None:
+            return _sys.missing(command)
+        try:
+            value = float(value)
+        except (ValueError, TypeError):
+            return _sys.invalid(command)
+        if self._deleted:
+            return
+        self._push(value)
+        self._changed()
+
+    # Add many values to the plot
+    def extend(self, values=None, *extra):
+        command = "plot.extend(values)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if values==None:
+            return _sys.missing(command)
+        try:
+            values = map(float, values)
+        except (ValueError, TypeError):
+            return _sys.invalid(command)
+        if self._deleted:
+            return
+        push = self._push
+        for value in values:
+            push(value)
+        self._changed()
+
+    # Get the values still held, oldest first
+    def values(self):
+        count = min(self._total, len(self._values))
+        start = (self._next-count) % len(self._values)
+        return (self._values[start:] + self._values[:start])[:count].tolist()
+
+    # Fix the vertical range of the plot, or fit it to the values when left out
+    def setRange(self, low=None, high=None, *extra):
+        command = "plot.setRange(low?,high?)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        try:
+            low = None if low==None else float(low)
+            high = None if high==None else float(high)
+        except (ValueError, TypeError):
+            return _sys.invalid(command)
+        if low is not None and high is not None and low >= high:
+            return _sys.restricted(command)
+        if self._deleted:
+            return
+        self._low, self._high = low, high
+        self._changed()
+
+    # Change the color and thickness of this plot
+    def paint(self, color=None, width=1, *extra):
+        command = "plot.paint(color,width?)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if color==None:
+            return _sys.missing(command)
+        try:
+            width = int(width)
+        except ValueError:
+            return _sys.invalid(command)
+        if width < 1:
+            return _sys.restricted(command)
+        if self._deleted:
+            return
+        self._restyle(fill=_sys.toHex(color), width=width)
 
 # (A shape specified by a single point)
 class _pointShape(_shape):
+    __slots__ = ["_x", "_y", "_right", "_bottom", "_width", "_height"]
+
     def __init__(self, canvas, x, y):
         super(_pointShape,self).__init__(canvas)
+        self._measure()
         self._configure(x, y)
 
-    # (Update the shape location)
+    # (Read-only edges)
+    left = _readOnly("left", lambda self : self._x)
+    top = _readOnly("top", lambda self : self._y)
+
+    # (Update the shape location; the size stays as last measured)
     def _configure(self, x, y):
-        self._canvas.coords(self._id, (x, y))
         self._x, self._y = x, y
-        self.__dict__["left"] = x
-        self.__dict__["top"] = y
-        self.__dict__["right"] = self._canvas.bbox(self._id)[2]
-        self.__dict__["bottom"] = self._canvas.bbox(self._id)[3]
+        self._right = x+self._width
+        self._bottom = y+self._height
+        self._moved()
+
+    # (Get the coordinates Tk should draw at)
+    def _coords(self):
+        return (self._x, self._y)
+
+    # (Follow a move the canvas already made)
+    def _shift(self, dx, dy):
+        self._x += dx
+        self._y += dy
+        self._right += dx
+        self._bottom += dy
+        self._reindex()
+
+    # (Find how far the right and bottom edges are from the location)
+    def _measure(self):
+        box = self._canvas.bbox(self._id)
+        (x, y) = self._canvas.coords(self._id)[:2]
+        self._width, self._height = int(box[2]-x), int(box[3]-y)
 
     # Move this shape
     def move(self, dx=None, dy=None, *extra):
@@ -717,15 +3577,35 @@ class _pointShape(_shape):
             return
         self._configure(x, y)
 
+# (Measured text sizes by (font, message), shared by all text shapes)
+_textSizes = {}
+_textSizeLimit = 4096
+
 # A text label
 class text(_pointShape):
+    __slots__ = ["_font", "_message"]
+
     def __init__(self, canvas, x, y, message):
-        self._id = canvas.create_text(0,0, text=message, font=("Helvetica",16), fill="black", anchor="nw")
+        self._font = ("Helvetica",16)
+        self._message = message
+        self._id = canvas.create_text(0,0, text=message, font=self._font, fill="black", anchor="nw")
         super(text,self).__init__(canvas, x, y)
 
+    # (Find the size of the message, measuring only fonts and messages not seen before)
+    def _measure(self):
+        key = (self._font, self._message)
+        size = _textSizes.get(key)
+        if size is None:
+            self._canvas.itemconfig(self._id, text=self._message, font=self._font)
+            super(text,self)._measure()
+            if len(_textSizes) >= _textSizeLimit:
+                _textSizes.clear()
+            size = _textSizes[key] = (self._width, self._height)
+        self._width, self._height = size
+
     # (Retrieve and type-convert the message)
     def __str__(self):
-        return self._canvas.itemcget(self._id, "text")
+        return self._message
     def __int__(self):
         try:
             return int(str(self))
@@ -750,7 +3630,10 @@ class text(_pointShape):
             return _sys.invalid(command)
         if self._deleted:
             return
-        self._canvas.itemconfig(self._id, text=message)
+        self._message = message
+        self._restyle(text=message)
+        self._measure()
+        self._configure(self._x, self._y)
 
     # Change the text style of this text
     def format(self, font=None, size=None, color=None, *extra):
@@ -765,13 +3648,17 @@ class text(_pointShape):
             return _sys.invalid(command)
         if self._deleted:
             return
-        self._canvas.itemconfig(self._id, font=(font,size), fill=_sys.toHex(color))
+        self._font = (font,size)
+        self._restyle(font=self._font, fill=_sys.toHex(color))
+        self._measure()
         self._configure(self._x, self._y)
 
 # A clickable button
 class button(_pointShape):
+    __slots__ = ["_button"]
+
     def __init__(self, canvas, x, y, message):
-        self._button = Tkinter.Button(canvas.master, text=message)
+        self._button = _sys.backend.button(canvas.master, message)
         self._id = canvas.create_window(x, y, anchor="nw", window=self._button)
         super(button,self).__init__(canvas, x, y)
 
@@ -803,6 +3690,8 @@ class button(_pointShape):
         if self._deleted:
             return
         self._button.config(text=message)
+        self._measure()
+        self._configure(self._x, self._y)
 
     # Assign a function to call when this button is pressed
     def onPress(self, function=None, *extra):
@@ -818,15 +3707,17 @@ class button(_pointShape):
         if self._deleted:
             return
         if len(inspect.getargspec(function)[0]) > 0:
-            self._button.config(command=lambda:function(self))
+            self._button.config(command=lambda:self._window._press(function, self))
         else:
-            self._button.config(command=lambda:function())
+            self._button.config(command=lambda:self._window._press(function))
 
 # An input field
 class field(_pointShape):
+    __slots__ = ["_message", "_entry"]
+
     def __init__(self, canvas, x, y, message):
-        self._message = Tkinter.StringVar(value=message)
-        self._entry = Tkinter.Entry(canvas.master, textvariable=self._message, relief="sunken", background="gray99")
+        self._message = _sys.backend.variable(canvas.master, message)
+        self._entry = _sys.backend.entry(canvas.master, self._message)
         self._id = canvas.create_window(x, y, anchor="nw", window=self._entry)
         self._entry.bind("<FocusIn>", lambda event : self._message.set(""))
         super(field,self).__init__(canvas, x, y)
@@ -860,21 +3751,36 @@ class field(_pointShape):
             return
         self._message.set(message)
 
-# A GIF image
+# An image from a GIF, PNG, PPM or PGM file
 class image(_pointShape):
-    def __init__(self, canvas, x, y, filename):
-        self._image = Tkinter.PhotoImage(master=canvas.master, file=filename)
-        self._label = Tkinter.Label(canvas.master, image=self._image, bd=0)
-        self._id = canvas.create_window(x, y, anchor="nw", window=self._label)
+    __slots__ = ["_image", "_shared", "_filters"]
+
+    def __init__(self, canvas, x, y, photo):
+        self._image = photo
+        self._shared = True # Whether the photo is also shown by other images
+        self._filters = [] # Queued (function, arguments, (columns, rows) afterwards)
+        self._id = canvas.create_image(x, y, anchor="nw", image=photo)
         super(image,self).__init__(canvas, x, y)
-        self.__dict__["columns"] = self._image.width()
-        self.__dict__["rows"] = self._image.height()
 
-    # (Disallow direct changes to some attributes)
-    def __setattr__(self, attribute, value):
-        if attribute in ["rows", "columns"]:
-            return _sys.immutable(attribute, "image")
-        super(image,self).__setattr__(attribute, value)
+    # (Read-only size in pixels, counting queued filters)
+    def _size(self):
+        if self._filters:
+            return self._filters[-1][2]
+        return (self._image.width(), self._image.height())
+    columns = _readOnly("columns", lambda self : self._size()[0])
+    rows = _readOnly("rows", lambda self : self._size()[1])
+
+    # (The size is the photo size, so there is nothing to ask the canvas)
+    def _measure(self):
+        self._width, self._height = self._image.width(), self._image.height()
+
+    # (Copy a shared photo before its pixels change, so other images keep the original)
+    def _own(self):
+        self._apply()
+        if self._shared:
+            self._shared = False
+            self._image = self._image.copy()
+            self._restyle(image=self._image)
 
     # (Allow indexing like image[col,row] to get pixel colors)
     def __getitem__(self, pixel):
@@ -887,6 +3793,7 @@ class image(_pointShape):
             return _sys.invalid(command)
         if self._deleted:
             return _sys.error("Can't index into a deleted image.")
+        self._apply()
         return tuple(map(int, self._image.get(col,row).split()))
 
     # (Allow indexing like image[col,row] to change pixel colors)
@@ -900,9 +3807,71 @@ class image(_pointShape):
             return _sys.invalid(command)
         if self._deleted:
             return
+        self._own()
         self._image.put(_sys.toHex(color), (col, row))
 
-   # Save this image to a file
+    # Get all the pixel colors as a bytearray of r,g,b values, row by row
+    def pixels(self, *extra):
+        command = "image.pixels()"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if self._deleted:
+            return _sys.error("Can't read pixels of a deleted image.")
+        self._apply()
+        return self._image.readBlock(0, 0, self.columns, self.rows)
+
+    # Change all the pixel colors from a buffer of r,g,b values, row by row
+    def setPixels(self, buffer=None, *extra):
+        command = "image.setPixels(buffer)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if buffer==None:
+            return _sys.missing(command)
+        self.setRegion(0, 0, self.columns, self.rows, buffer)
+
+    # Get the pixel colors in a block as a bytearray of r,g,b values, row by row
+    def region(self, col=None, row=None, width=None, height=None, *extra):
+        command = "image.region(col,row,width,height)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if col==None or row==None or width==None or height==None:
+            return _sys.missing(command)
+        try:
+            col, row, width, height = int(col), int(row), int(width), int(height)
+        except ValueError:
+            return _sys.invalid(command)
+        if not self._contains(col, row, width, height):
+            return _sys.restricted(command)
+        if self._deleted:
+            return _sys.error("Can't read pixels of a deleted image.")
+        self._apply()
+        return self._image.readBlock(col, row, width, height)
+
+    # Change the pixel colors in a block from a buffer of r,g,b values, row by row
+    def setRegion(self, col=None, row=None, width=None, height=None, buffer=None, *extra):
+        command = "image.setRegion(col,row,width,height,buffer)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if col==None or row==None or width==None or height==None or buffer==None:
+            return _sys.missing(command)
+        try:
+            col, row, width, height = int(col), int(row), int(width), int(height)
+            buffer = _bytes(buffer)
+        except (ValueError, TypeError):
+            return _sys.invalid(command)
+        if not self._contains(col, row, width, height) or len(buffer) != width*height*3:
+            return _sys.restricted(command)
+        if self._deleted:
+            return
+        self._own()
+        self._image.writeBlock(col, row, width, buffer)
+
+    # (Check that a block lies inside the image)
+    def _contains(self, col, row, width, height):
+        return col >= 0 and row >= 0 and width > 0 and height > 0 and col+width <= self.columns and row+height <= self.rows
+
+
+   # Save this image to a file, as PNG, PPM or PGM if the name ends that way, or else as GIF
     def saveAs(self, filename=None, *extra):
         command = "image.saveAs(filename)"
         if len(extra) > 0:
@@ -915,4 +3884,663 @@ class image(_pointShape):
             return _sys.invalid(command)
         if self._deleted:
             _sys.error("Can't save a deleted image.")
-        self._image.write(filename, format="GIF")
+        self._apply()
+        self._image.saveAs(filename)
+
+    # Count the pixels with each value, as lists of 256 counts for red, green and blue
+    def histogram(self, *extra):
+        command = "image.histogram()"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if self._deleted:
+            return _sys.error("Can't read pixels of a deleted image.")
+        self._apply()
+        return _histogram(self._image.readBlock(0, 0, self.columns, self.rows))
+
+    # Queue a convolution with a grid of weights, divided by the divisor or else their total; returns the image
+    def convolve(self, kernel=None, divisor=None, *extra):
+        command = "image.convolve(kernel,divisor?)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if kernel==None:
+            return _sys.missing(command)
+        try:
+            kernel = [[float(weight) for weight in row] for row in kernel]
+            if divisor==None:
+                divisor = sum(map(sum, kernel)) or 1.0
+            divisor = float(divisor)
+        except (ValueError, TypeError):
+            return _sys.invalid(command)
+        if not kernel or len(kernel) % 2 == 0 or len(kernel[0]) % 2 == 0 or len(set(map(len, kernel))) != 1 or divisor == 0:
+            return _sys.restricted(command)
+        return self._queue(_convolve, (kernel, divisor), self._size())
+
+    # Queue a change of each pixel to rows of weights times (r,g,b), plus an optional offset per row; returns the image
+    def colorMatrix(self, matrix=None, *extra):
+        command = "image.colorMatrix(matrix)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if matrix==None:
+            return _sys.missing(command)
+        try:
+            matrix = [[float(weight) for weight in row] for row in matrix]
+        except (ValueError, TypeError):
+            return _sys.invalid(command)
+        if len(matrix) != 3 or [row for row in matrix if len(row) not in [3, 4]]:
+            return _sys.restricted(command)
+        return self._queue(_colorMatrix, ([row+[0.0]*(4-len(row)) for row in matrix],), self._size())
+
+    # Queue a change of size, picking the nearest pixels; returns the image
+    def resize(self, columns=None, rows=None, *extra):
+        command = "image.resize(columns,rows)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if columns==None or rows==None:
+            return _sys.missing(command)
+        try:
+            columns, rows = int(columns), int(rows)
+        except ValueError:
+            return _sys.invalid(command)
+        if columns < 1 or rows < 1:
+            return _sys.restricted(command)
+        return self._queue(_resize, (columns, rows), (columns, rows))
+
+    # Queue a change of size by a factor, picking the nearest pixels; returns the image
+    def scale(self, factor=None, *extra):
+        command = "image.scale(factor)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if factor==None:
+            return _sys.missing(command)
+        try:
+            factor = float(factor)
+        except ValueError:
+            return _sys.invalid(command)
+        (columns, rows) = [int(round(n*factor)) for n in self._size()]
+        if columns < 1 or rows < 1:
+            return _sys.restricted(command)
+        return self._queue(_resize, (columns, rows), (columns, rows))
+
+    # Queue cutting the image down to a block; returns the image
+    def crop(self, col=None, row=None, width=None, height=None, *extra):
+        command = "image.crop(col,row,width,height)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if col==None or row==None or width==None or height==None:
+            return _sys.missing(command)
+        try:
+            col, row, width, height = int(col), int(row), int(width), int(height)
+        except ValueError:
+            return _sys.invalid(command)
+        if not self._contains(col, row, width, height):
+            return _sys.restricted(command)
+        return self._queue(_crop, (col, row, width, height), (width, height))
+
+    # Queue a mirror image, "horizontal" (left to right) or "vertical" (top to bottom); returns the image
+    def flip(self, direction="horizontal", *extra):
+        command = "image.flip(direction?)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if direction not in ["horizontal", "vertical"]:
+            return _sys.restricted(command)
+        return self._queue(_flip, (direction == "vertical",), self._size())
+
+    # Queue a clockwise turn by 90, 180 or 270 degrees; returns the image
+    def rotate(self, degrees=None, *extra):
+        command = "image.rotate(degrees)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if degrees==None:
+            return _sys.missing(command)
+        try:
+            turns = int(degrees) // 90 % 4
+        except ValueError:
+            return _sys.invalid(command)
+        if int(degrees) % 90 != 0:
+            return _sys.restricted(command)
+        (columns, rows) = self._size()
+        return self._queue(_rotate, (turns,), (rows, columns) if turns % 2 else (columns, rows))
+
+    # (Queue a filter to run at the next flush or pixel access, moving the edges now if it changes the size)
+    def _queue(self, function, arguments, size):
+        if self._deleted:
+            return self
+        self._filters.append((function, arguments, size))
+        if size != (self._width, self._height):
+            (self._width, self._height) = size
+            (self._right, self._bottom) = (self._x+self._width, self._y+self._height)
+            self._reindex()
+        if self._window is not None:
+            self._window._markDirty(self)
+        return self
+
+    # (Run the queued filters with one read of the pixels and one write back)
+    def _apply(self):
+        filters = self._filters
+        if not filters:
+            return
+        self._filters = []
+        (columns, rows) = (self._image.width(), self._image.height())
+        pixels = self._image.readBlock(0, 0, columns, rows)
+        if _numpy is not None:
+            pixels = _numpy.frombuffer(pixels, dtype=_numpy.uint8).reshape(rows, columns, 3)
+        for (function, arguments, size) in filters:
+            (columns, rows, pixels) = function(columns, rows, pixels, *arguments)
+        resized = (columns, rows) != (self._image.width(), self._image.height())
+        if self._shared or resized:
+            self._shared = False
+            self._image = self._image.blank(columns, rows)
+            self._restyle(image=self._image)
+        self._image.writeBlock(0, 0, columns, _bytes(pixels))
+
+    # (Bring the photo up to date before sending changes to the canvas)
+    def _render(self, ops):
+        self._apply()
+        super(image,self)._render(ops)
+
+# An image showing one frame of a sprite sheet at a time
+class sprite(image):
+    __slots__ = ["_sheet", "_frame"]
+
+    def __init__(self, canvas, x, y, sheet, frame):
+        self._sheet = sheet
+        self._frame = frame
+        super(sprite,self).__init__(canvas, x, y, sheet._slice()[frame])
+
+    # (Read-only frame number)
+    frame = _readOnly("frame", lambda self : self._frame)
+
+    # Show another frame of the sheet; changed pixels and queued filters are dropped
+    def setFrame(self, frame=None, *extra):
+        command = "sprite.setFrame(frame)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if frame==None:
+            return _sys.missing(command)
+        try:
+            frame = int(frame)
+        except ValueError:
+            return _sys.invalid(command)
+        frames = self._sheet._slice()
+        if frame < 0 or frame >= len(frames):
+            return _sys.restricted(command)
+        if self._deleted or (frame == self._frame and self._shared and not self._filters):
+            return
+        self._filters = []
+        self._frame = frame
+        self._image = frames[frame]
+        self._shared = True
+        self._restyle(image=self._image)
+        if self._size() != (self._width, self._height): # Dropped a queued resize
+            self._measure()
+            self._configure(self._x, self._y)
+
+# A GIF image cut into equal frames, numbered row by row from 0, for window.addSprite
+class sheet(object):
+    __slots__ = ["_filename", "_width", "_height", "_source", "_frames"]
+
+    def __init__(self, filename=None, width=None, height=None, *extra):
+        command = "intrographics.sheet(filename,width,height)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if filename==None or width==None or height==None:
+            return _sys.missing(command)
+        try:
+            filename, width, height = str(filename), int(width), int(height)
+        except ValueError:
+            return _sys.invalid(command)
+        if width < 1 or height < 1:
+            return _sys.restricted(command)
+        self._filename = filename
+        self._width, self._height = width, height
+        self._source = None # Photo the frames were cut from
+        self._frames = []
+
+    # (Read-only frame size and count)
+    width = _readOnly("width", lambda self : self._width)
+    height = _readOnly("height", lambda self : self._height)
+    count = _readOnly("count", lambda self : len(self._slice()))
+
+    # (Cut the frames the first time they are needed, and again only if the file changes)
+    def _slice(self):
+        if _sys.root is None:
+            return _sys.error("Can't use a sheet before a window is made.")
+        source = _sys.photo(self._filename)
+        if source is not self._source:
+            (width, height) = (self._width, self._height)
+            self._frames = [source.slice(col, row, width, height)
+                            for row in xrange(0, source.height()-height+1, height)
+                            for col in xrange(0, source.width()-width+1, width)]
+            self._source = source
+        return self._frames
+
+    def __repr__(self):
+        return "sheet("+repr(self._filename)+", "+repr(self._width)+", "+repr(self._height)+")"
+
+#########################################################################
+# Image filters
+#########################################################################
+
+# Each filter turns (columns, rows, pixels) into new ones, where pixels is a
+# rows x columns x 3 NumPy array if NumPy is installed, or else r,g,b bytes
+
+# (Weighted sum of the neighbors of each pixel, repeating the edge pixels)
+def _convolve(columns, rows, pixels, kernel, divisor):
+    height, width = len(kernel), len(kernel[0])
+    cy, cx = height//2, width//2
+    if _numpy is not None:
+        source = _numpy.pad(pixels.astype(float), ((cy, cy), (cx, cx), (0, 0)), "edge")
+        total = _numpy.zeros((rows, columns, 3))
+        for (j, weights) in enumerate(kernel):
+            for (i, weight) in enumerate(weights):
+                if weight:
+                    total += (weight/divisor)*source[j:j+rows, i:i+columns]
+        return (columns, rows, _numpy.clip(_numpy.floor(total+0.5), 0, 255).astype(_numpy.uint8))
+    return (columns, rows, _byRows(_convolveRows, columns, rows, pixels, cy, (kernel, divisor)))
+
+# (Convolve some rows, from pixels that start at row top of the image)
+def _convolveRows(columns, rows, pixels, top, first, last, kernel, divisor):
+    height, width = len(kernel), len(kernel[0])
+    stride = columns*3
+    taps = [(j-height//2, i-width//2, weight/divisor) for (j, weights) in enumerate(kernel) for (i, weight) in enumerate(weights) if weight]
+    result = bytearray()
+    for y in xrange(first, last):
+        total = [0.0]*stride
+        for (dy, dx, weight) in taps:
+            start = (min(max(y+dy, 0), rows-1)-top)*stride
+            line = pixels[start:start+stride]
+            if dx > 0:
+                line = line[dx*3:]+line[-3:]*dx
+            elif dx < 0:
+                line = line[:3]*-dx+line[:dx*3]
+            total = map(add, total, map(weight.__mul__, line))
+        result += bytearray([0 if v < 0 else 255 if v > 255 else int(v+0.5) for v in total])
+    return result
+
+# (Each channel becomes a weighted sum of r, g, b and an offset)
+def _colorMatrix(columns, rows, pixels, matrix):
+    if _numpy is not None:
+        source = pixels.astype(float)
+        total = _numpy.dstack([source[..., 0]*r+offset+source[..., 1]*g+source[..., 2]*b for (r, g, b, offset) in matrix])
+        return (columns, rows, _numpy.clip(_numpy.floor(total+0.5), 0, 255).astype(_numpy.uint8))
+    return (columns, rows, _byRows(_colorMatrixRows, columns, rows, pixels, 0, (matrix,)))
+
+# (Change the colors of some rows, from pixels that start at row top of the image)
+def _colorMatrixRows(columns, rows, pixels, top, first, last, matrix):
+    stride = columns*3
+    pixels = pixels[(first-top)*stride:(last-top)*stride]
+    reds, greens, blues = pixels[0::3], pixels[1::3], pixels[2::3]
+    result = bytearray(len(pixels))
+    for (channel, (r, g, b, offset)) in enumerate(matrix):
+        red = [r*v+offset for v in xrange(256)]
+        green = [g*v for v in xrange(256)]
+        blue = [b*v for v in xrange(256)]
+        total = [red[x]+green[y]+blue[z] for (x, y, z) in zip(reds, greens, blues)]
+        result[channel::3] = bytearray([0 if v < 0 else 255 if v > 255 else int(v+0.5) for v in total])
+    return result
+
+# (Images with fewer pixels than this are filtered in this process, since starting workers costs more)
+_tileLimit = 256*256
+
+# (Run a filter of rows over a whole image, split into bands across worker processes if it is big enough;
+#  rows within reach above and below a band are also read, and the pixels are shared rather than pickled)
+def _byRows(function, columns, rows, pixels, reach, arguments):
+    workers = min(_sys.workers, rows)
+    if workers < 2 or columns*rows < _tileLimit:
+        return function(columns, rows, pixels, 0, 0, rows, *arguments)
+    source = RawArray("B", len(pixels))
+    result = RawArray("B", len(pixels))
+    ctypes.memmove(source, (ctypes.c_char*len(pixels)).from_buffer(pixels), len(pixels))
+    bands = [(rows*n//(workers*2), rows*(n+1)//(workers*2)) for n in xrange(workers*2)]
+    tasks = [(function, columns, rows, max(first-reach, 0), min(last+reach, rows), first, last, arguments)
+             for (first, last) in bands if first < last]
+    pool = multiprocessing.Pool(workers, _tileStart, (source, result))
+    try:
+        pool.map(_tileRun, tasks)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return bytearray(ctypes.string_at(result, len(pixels)))
+
+# (Shared pixel buffers, in a worker process)
+_tileSource = _tileResult = None
+
+# (Keep the shared buffers when a worker process starts)
+def _tileStart(source, result):
+    global _tileSource, _tileResult
+    _tileSource, _tileResult = source, result
+
+# (Filter one band of rows in a worker process, straight from and into the shared buffers)
+def _tileRun(task):
+    (function, columns, rows, top, bottom, first, last, arguments) = task
+    stride = columns*3
+    pixels = bytearray(ctypes.string_at(ctypes.addressof(_tileSource)+top*stride, (bottom-top)*stride))
+    band = str(function(columns, rows, pixels, top, first, last, *arguments))
+    ctypes.memmove(ctypes.addressof(_tileResult)+first*stride, band, len(band))
+
+# (Nearest-pixel change of size)
+def _resize(columns, rows, pixels, width, height):
+    ys = [y*rows//height for y in xrange(height)]
+    xs = [x*columns//width for x in xrange(width)]
+    if _numpy is not None:
+        return (width, height, pixels[ys][:, xs])
+    return (width, height, _remap(pixels, [y*columns+x for y in ys for x in xs]))
+
+# (A block of the image)
+def _crop(columns, rows, pixels, col, row, width, height):
+    if _numpy is not None:
+        return (width, height, pixels[row:row+height, col:col+width])
+    stride = columns*3
+    block = bytearray()
+    for y in xrange(row, row+height):
+        block += pixels[y*stride+col*3:y*stride+(col+width)*3]
+    return (width, height, block)
+
+# (Mirror image left to right, or top to bottom)
+def _flip(columns, rows, pixels, vertical):
+    if _numpy is not None:
+        return (columns, rows, pixels[::-1] if vertical else pixels[:, ::-1])
+    if vertical:
+        return (columns, rows, _remap(pixels, [y*columns+x for y in xrange(rows-1, -1, -1) for x in xrange(columns)]))
+    return (columns, rows, _remap(pixels, [y*columns+x for y in xrange(rows) for x in xrange(columns-1, -1, -1)]))
+
+# (Clockwise turn by some quarter turns)
+def _rotate(columns, rows, pixels, turns):
+    if _numpy is not None:
+        pixels = _numpy.rot90(pixels, -turns)
+        return (pixels.shape[1], pixels.shape[0], pixels)
+    if turns == 1:
+        return (rows, columns, _remap(pixels, [y*columns+x for x in xrange(columns) for y in xrange(rows-1, -1, -1)]))
+    if turns == 2:
+        return (columns, rows, _remap(pixels, range(columns*rows-1, -1, -1)))
+    if turns == 3:
+        return (rows, columns, _remap(pixels, [y*columns+x for x in xrange(columns-1, -1, -1) for y in xrange(rows)]))
+    return (columns, rows, pixels)
+
+# (New pixels taken from the pixels at some indexes, one channel at a time)
+def _remap(pixels, sources):
+    result = bytearray(len(sources)*3)
+    for channel in xrange(3):
+        values = pixels[channel::3]
+        result[channel::3] = bytearray([values[i] for i in sources])
+    return result
+
+# (Counts of each value in each channel of r,g,b bytes)
+def _histogram(pixels):
+    if _numpy is not None:
+        values = _numpy.frombuffer(pixels, dtype=_numpy.uint8)
+        return [_numpy.bincount(values[channel::3], minlength=256).tolist() for channel in xrange(3)]
+    channels = [str(pixels[channel::3]) for channel in xrange(3)]
+    return [[values.count(chr(v)) for v in xrange(256)] for values in channels]
+
+# (Get the raw bytes of a pixel buffer)
+def _bytes(buffer):
+    if _numpy is not None and isinstance(buffer, _numpy.ndarray):
+        return buffer.astype(_numpy.uint8).tostring()
+    return str(bytearray(buffer))
+
+# (Make a float buffer, using NumPy when it is available)
+def _buffer(count, value=0.0):
+    if _numpy is not None:
+        return _numpy.zeros(count) + value
+    return array("d", [value]) * count
+
+# (Make a buffer of 0xRRGGBB color values, using NumPy when it is available)
+def _colorBuffer(count, value=0):
+    if _numpy is not None:
+        return _numpy.zeros(count, dtype=_numpy.int32) + value
+    return array("i", [value]) * count
+
+# A batch of many small shapes whose positions, velocities, sizes and colors are kept in flat arrays
+class particles(object):
+    def __init__(self, canvas, count, kind, size):
+        self._canvas = canvas
+        self._window = None
+        self._deleted = False
+        self._stale = True
+        self._color = None # Color for every item, not yet sent
+        self._tag = "particles"+str(id(self))
+        self._ids = canvas.createBatch(kind, count, self._tag)
+        self.__dict__["count"] = count
+        self.x = _buffer(count)
+        self.y = _buffer(count)
+        self.vx = _buffer(count)
+        self.vy = _buffer(count)
+        self.size = _buffer(count, size)
+        self.color = _colorBuffer(count) # 0xRRGGBB for each particle
+        self._shown = _colorBuffer(count) # Colors the canvas has
+        self.paint("black")
+
+    # (Disallow direct changes to some attributes)
+    def __setattr__(self, attribute, value):
+        if attribute == "count":
+            return _sys.immutable(attribute, "particles")
+        super(particles,self).__setattr__(attribute, value)
+
+    # Move every particle by its velocity
+    def step(self, dt=1, *extra):
+        command = "particles.step(dt?)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        try:
+            dt = float(dt)
+        except (ValueError, TypeError):
+            return _sys.invalid(command)
+        if self._deleted:
+            return
+        x, y, vx, vy = self.x, self.y, self.vx, self.vy
+        if _numpy is not None:
+            x += vx*dt
+            y += vy*dt
+        elif dt == 1:
+            x[:] = array("d", map(add, x, vx))
+            y[:] = array("d", map(add, y, vy))
+        else:
+            x[:] = array("d", [a+b*dt for (a,b) in zip(x, vx)])
+            y[:] = array("d", [a+b*dt for (a,b) in zip(y, vy)])
+        self.redraw()
+
+    # Reflect particles (and their velocities) off the edges of a box
+    def bounce(self, left=0, top=0, right=None, bottom=None, *extra):
+        box = self._box("particles.bounce(left?,top?,right?,bottom?)", left, top, right, bottom, extra)
+        if box is None:
+            return
+        (left, top, right, bottom) = box
+        self._reflect(self.x, self.vx, left, right)
+        self._reflect(self.y, self.vy, top, bottom)
+        self.redraw()
+
+    # (Reflect positions that passed low or high along one axis)
+    def _reflect(self, p, v, low, high):
+        s = self.size
+        if _numpy is not None:
+            under = p < low
+            p[under] = 2*low - p[under]
+            v[under] = abs(v[under])
+            over = p + s > high
+            p[over] = 2*(high - s[over]) - p[over]
+            v[over] = -abs(v[over])
+            return
+        for i in xrange(len(p)):
+            if p[i] < low:
+                p[i] = 2*low - p[i]
+                v[i] = abs(v[i])
+            elif p[i] + s[i] > high:
+                p[i] = 2*(high - s[i]) - p[i]
+                v[i] = -abs(v[i])
+
+    # (Check the box for bounce or wrap, defaulting to the window; None if there is nothing to do)
+    def _box(self, command, left, top, right, bottom, extra):
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if right==None:
+            right = self._window.width
+        if bottom==None:
+            bottom = self._window.height
+        try:
+            left, top, right, bottom = int(left), int(top), int(right), int(bottom)
+        except (ValueError, TypeError):
+            return _sys.invalid(command)
+        if right <= left or bottom <= top:
+            return _sys.restricted(command)
+        if self._deleted:
+            return None
+        return (left, top, right, bottom)
+
+    # Move particles that left a box back in through the opposite edge
+    def wrap(self, left=0, top=0, right=None, bottom=None, *extra):
+        box = self._box("particles.wrap(left?,top?,right?,bottom?)", left, top, right, bottom, extra)
+        if box is None:
+            return
+        (left, top, right, bottom) = box
+        for (p, low, high) in [(self.x, left, right), (self.y, top, bottom)]:
+            span = high - low
+            if _numpy is not None:
+                p[:] = low + (p - low) % span
+            else:
+                p[:] = array("d", [low + (c - low) % span for c in p])
+        self.redraw()
+
+    # Give every particle, or just the one at an index, the same color
+    def paint(self, color=None, index=None, *extra):
+        command = "particles.paint(color,index?)"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if color==None:
+            return _sys.missing(command)
+        if index is not None:
+            try:
+                index = int(index)
+            except (ValueError, TypeError):
+                return _sys.invalid(command)
+            if index < 0 or index >= self.count:
+                return _sys.restricted(command)
+        if self._deleted:
+            return
+        value = int(_sys.toHex(color)[1:], 16)
+        if index is None:
+            self._color = value
+            self.color[:] = _colorBuffer(self.count, value)
+        else:
+            self.color[index] = value
+        self.redraw()
+
+    # Redraw after changing the position, size or color arrays directly
+    def redraw(self, *extra):
+        command = "particles.redraw()"
+        if len(extra) > 0:
+            return _sys.extra(command)
+        if self._deleted:
+            return
+        self._stale = True
+        if self._window is not None:
+            self._window._markDirty(self)
+        else:
+            ops = []
+            self._render(ops)
+            self._canvas.batch(ops)
+
+    # (Add the canvas operations that bring this batch up to date: one call for a color shared by all, then one for the particles whose colors differ from what the canvas has)
+    def _render(self, ops):
+        shown = self._shown
+        if self._color is not None:
+            ops.append(("config", self._tag, {"fill":"#%06x" % self._color}))
+            shown[:] = _colorBuffer(self.count, self._color)
+            self._color = None
+        if not self._stale:
+            return
+        self._stale = False
+        color = self.color
+        if _numpy is not None:
+            changed = _numpy.flatnonzero(color != shown).tolist()
+        elif color != shown:
+            changed = [i for i in xrange(len(color)) if color[i] != shown[i]]
+        else:
+            changed = []
+        if changed:
+            ids = self._ids
+            ops.append(("fill", [ids[i] for i in changed], ["#%06x" % (color[i] & 0xffffff) for i in changed]))
+            shown[:] = color
+        n = self.count
+        flat = [0] * (3*n)
+        if _numpy is not None:
+            flat = _numpy.column_stack((self.x, self.y, self.size)).astype(int).ravel().tolist()
+        else:
+            flat[0::3] = map(int, self.x)
+            flat[1::3] = map(int, self.y)
+            flat[2::3] = map(int, self.size)
+        ops.append(("place", self._ids, flat))
+
+    # (Mark this batch as removed once its items are gone)
+    def _forget(self):
+        self._deleted = True
+
+# (Lean methods for shapes in optimized windows, without argument checking)
+class _leanBox(object):
+    __slots__ = []
+    def move(self, dx, dy):
+        if not self._deleted:
+            self._configure(self._x+dx, self._y+dy, self._width, self._height)
+    def relocate(self, x, y):
+        if not self._deleted:
+            self._configure(x, y, self._width, self._height)
+    def resize(self, width, height):
+        if not self._deleted:
+            self._configure(self._x, self._y, width, height)
+    def paint(self, color, borderWidth=1, borderColor="black"):
+        if not self._deleted:
+            self._restyle(fill=_sys.toHex(color), width=borderWidth, outline=_sys.toHex(borderColor))
+
+class _leanList(object):
+    __slots__ = []
+    def move(self, dx, dy):
+        try:
+            dx, dy = int(dx), int(dy) # Points are packed as ints, so catch bad offsets here rather than at the next redraw
+        except (ValueError, TypeError):
+            return _sys.invalid(self.__class__.__name__+".move(dx,dy)")
+        if not self._deleted:
+            self._translate(dx, dy)
+
+class _leanPolygon(_leanList):
+    __slots__ = []
+    def paint(self, color, borderWidth=1, borderColor="black"):
+        if self._deleted:
+            return
+        if borderWidth == 0:
+            self._restyle(fill=_sys.toHex(color), width=borderWidth)
+        else:
+            self._restyle(fill=_sys.toHex(color), width=borderWidth, outline=_sys.toHex(borderColor))
+
+class _leanLine(_leanList):
+    __slots__ = []
+    def paint(self, color, width=1):
+        if not self._deleted:
+            self._restyle(fill=_sys.toHex(color), width=width)
+
+class _leanPoint(object):
+    __slots__ = []
+    def move(self, dx, dy):
+        if not self._deleted:
+            self._configure(self._x+dx, self._y+dy)
+    def relocate(self, x, y):
+        if not self._deleted:
+            self._configure(x, y)
+
+# (Lean subclass of each shape class, named like the original)
+_lean = {}
+for _base, _mixin in [(rectangle, _leanBox), (oval, _leanBox), (polygon, _leanPolygon), (line, _leanLine),
+                      (text, _leanPoint), (button, _leanPoint), (field, _leanPoint), (image, _leanPoint),
+                      (sprite, _leanPoint)]:
+    _lean[_base] = type(_base.__name__, (_mixin, _base), {"__slots__":[]})
+del _base, _mixin
+
+# (Switch a shape class to or from its lean subclass)
+def _leanClass(cls, enabled):
+    if enabled:
+        return _lean.get(cls, cls)
+    if cls in _lean.values():
+        return cls.__bases__[1]
+    return cls